@@ -0,0 +1,365 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+from download_journal import JOURNAL_FILENAME
+
+################################## argument parsing ###########################################
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--scales",
+    type=str,
+    default="100,1000",
+    help="Comma separated numbers of articles, one benchmark round per scale",
+)
+parser.add_argument(
+    "--imgs-per-article", type=int, default=8, help="Media links per synthetic article"
+)
+parser.add_argument(
+    "--concurrency",
+    type=str,
+    default="16,64",
+    help="Comma separated `--max-concurrency` values compared for `download_asyncio.py`",
+)
+parser.add_argument(
+    "--host-rate",
+    type=float,
+    default=10,
+    help="Initial requests per second per host of `download_asyncio.py`, high values take the rate limiter out of the comparison",
+)
+parser.add_argument(
+    "--maxproc",
+    type=int,
+    default=4,
+    help="Worker processes of `multiprocess_download.py` and `postprocess.py`",
+)
+parser.add_argument("--port", type=int, default=8790, help="Port of the mock image server")
+parser.add_argument(
+    "--latency", type=float, default=0.02, help="Seconds the mock server waits per request"
+)
+parser.add_argument(
+    "--jitter", type=float, default=0.05, help="Up to this many extra seconds of random wait"
+)
+parser.add_argument(
+    "--error-rate", type=float, default=0.01, help="Fraction of requests answered with 500"
+)
+parser.add_argument(
+    "--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429"
+)
+parser.add_argument(
+    "--workdir",
+    type=str,
+    default=None,
+    help="Directory for the synthetic metadata and downloads, a temporary directory (removed afterwards) if not given",
+)
+parser.add_argument(
+    "--output", type=str, default=None, help="Write the results as JSON to this file"
+)
+parser.add_argument("--seed", type=int, default=0, help="Random seed")
+############################################################################################
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# (width, height, extension) of the synthetic images, the last two fail the postprocessing filter
+IMAGE_SHAPES = (
+    (640, 480, "jpg"),
+    (1024, 768, "jpg"),
+    (480, 640, "png"),
+    (512, 512, "webp"),
+    (40, 40, "png"),
+    (900, 100, "gif"),
+)
+
+
+def generate_metadata(
+    path: Path,
+    num_articles: int,
+    imgs_per_article: int,
+    base_url: str,
+    seed: int = 0,
+    duplicate_rate: float = 0.05,
+    skip_rate: float = 0.05,
+    missing_rate: float = 0.02,
+):
+    """Write a synthetic `.metadata` file of articles pointing to the mock image server.
+
+    A fraction of the links repeat an image of an earlier article, are skip links, or point to images that do not
+    exist, so every code path of the downloader and postprocessing is exercised.
+
+    Args:
+        path (Path): Metadata file to write
+        num_articles (int): Number of articles
+        imgs_per_article (int): Media links per article
+        base_url (str): Base URL of the mock image server
+        seed (int, optional): Random seed. Defaults to 0.
+        duplicate_rate (float, optional): Fraction of links repeating an earlier image. Defaults to 0.05.
+        skip_rate (float, optional): Fraction of skip links. Defaults to 0.05.
+        missing_rate (float, optional): Fraction of links answered with 404. Defaults to 0.02.
+    """
+    rng = random.Random(seed)
+    img_urls = []
+    with path.open("w") as f:
+        for article_idx in range(num_articles):
+            media_links = []
+            for idx in range(imgs_per_article):
+                roll = rng.random()
+                if roll < duplicate_rate and len(img_urls) > 0:
+                    media_links.append(rng.choice(img_urls))
+                    continue
+                if roll < duplicate_rate + skip_rate:
+                    media_links.append("https://www.youtube.com/embed/bench.html")
+                    continue
+
+                width, height, ext = rng.choice(IMAGE_SHAPES)
+                name = "missing" if roll < duplicate_rate + skip_rate + missing_rate else "img"
+                img_url = f"{base_url}/img/{name}{article_idx}_{idx}_{width}x{height}.{ext}"
+                img_urls.append(img_url)
+                media_links.append(img_url)
+
+            article = {
+                "id": f"bench-{article_idx}",
+                "url": f"{base_url}/news/{article_idx}",
+                "media_links": media_links,
+            }
+            f.write(json.dumps(article) + "\n")
+
+
+def start_mock_server(args: argparse.Namespace) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(SCRIPTS_DIR / "mock_image_server.py"),
+            "--port", str(args.port),
+            "--latency", str(args.latency),
+            "--jitter", str(args.jitter),
+            "--error-rate", str(args.error_rate),
+            "--throttle-rate", str(args.throttle_rate),
+            "--seed", str(args.seed),
+        ]
+    )  # fmt: skip
+
+    # wait until it accepts requests
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{args.port}/stats", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Mock image server did not start")
+
+
+def run_measured(cmd: list[str], stdin: str = "") -> dict:
+    """Run a benchmarked script to completion.
+
+    Args:
+        cmd (list[str]): Command line
+        stdin (str, optional): Input, to answer the scripts' confirmation prompt. Defaults to "".
+
+    Returns:
+        dict: Wall time in seconds, peak RSS in MiB of the process (or its largest worker process) and exit code
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(
+        cmd,
+        cwd=SCRIPTS_DIR,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    process.stdin.write(stdin)
+    process.stdin.close()
+    # the resource usage of this child alone, including the worker processes it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "seconds": time.monotonic() - start,
+        "peak_rss_mib": usage.ru_maxrss / 1024,
+        "returncode": process.returncode,
+    }
+
+
+def read_latency_quantiles(metrics_files: list[Path]) -> dict:
+    """Merge the final latency histograms of all hosts and processes of a run.
+
+    Args:
+        metrics_files (list[Path]): Metrics files written by the run
+
+    Returns:
+        dict: p50, p90 and p99 request latency in seconds (bucket upper bounds)
+    """
+    buckets: dict[str, int] = {}
+    for metrics_file in metrics_files:
+        with metrics_file.open() as f:
+            lines = f.read().splitlines()
+        if len(lines) == 0:
+            continue
+        for host in json.loads(lines[-1])["hosts"].values():
+            for bound, count in host["latency"]["buckets"].items():
+                buckets[bound] = buckets.get(bound, 0) + count
+
+    total = sum(buckets.values())
+    quantiles = {}
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        seen = 0
+        quantiles[name] = None
+        for bound, count in buckets.items():
+            seen += count
+            if total > 0 and seen >= q * total:
+                quantiles[name] = float(bound)
+                break
+    return quantiles
+
+
+def count_journal_images(download_dir: Path) -> dict[str, int]:
+    conn = sqlite3.connect(str(download_dir / JOURNAL_FILENAME))
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM images GROUP BY status"))
+    conn.close()
+    return counts
+
+
+def bench_download_asyncio(
+    workdir: Path,
+    metadata: Path,
+    num_articles: int,
+    max_concurrency: int,
+    host_rate: float,
+) -> dict:
+    download_dir = workdir / f"asyncio-c{max_concurrency}" / metadata.stem
+    metrics_file = download_dir.parent / "metrics.jsonl"
+    download_dir.mkdir(parents=True)
+    result = run_measured(
+        [
+            sys.executable, "download_asyncio.py",
+            "--download-dir", str(download_dir),
+            "--metadata", str(metadata),
+            "--start-idx", "0",
+            "--end-idx", str(num_articles),
+            "--max-concurrency", str(max_concurrency),
+            "--host-rate", str(host_rate),
+            "--max-retry", "3",
+            "--quiet",
+            "--metrics-file", str(metrics_file),
+        ]
+    )  # fmt: skip
+    counts = count_journal_images(download_dir)
+    result["images"] = counts.get("DONE", 0)
+    result["images_per_s"] = result["images"] / result["seconds"]
+    result.update(read_latency_quantiles([metrics_file]))
+    return result
+
+
+def bench_multiprocess_download(
+    workdir: Path, metadata: Path, maxproc: int
+) -> tuple[dict, Path]:
+    download_root = workdir / f"multiprocess-p{maxproc}"
+    metrics_file = download_root / "metrics.jsonl"
+    download_root.mkdir(parents=True)
+    result = run_measured(
+        [
+            sys.executable, "multiprocess_download.py",
+            "--download-dir", str(download_root),
+            "--metadata-path", str(metadata),
+            "--maxproc", str(maxproc),
+            "--max-retry", "3",
+            "--metrics-file", str(metrics_file),
+        ],
+        stdin="\n",
+    )  # fmt: skip
+    download_dir = download_root / metadata.stem
+    counts = count_journal_images(download_dir)
+    result["images"] = counts.get("DONE", 0)
+    result["images_per_s"] = result["images"] / result["seconds"]
+    result.update(
+        read_latency_quantiles(list(download_root.glob("metrics.*.jsonl")))
+    )
+    return result, download_dir
+
+
+def bench_postprocess(img_dir: Path, maxproc: int, num_articles: int) -> dict:
+    result = run_measured(
+        [
+            sys.executable, "postprocess.py",
+            "--imgdir", str(img_dir),
+            "--maxproc", str(maxproc),
+            "--full",
+        ],
+        stdin="\n",
+    )  # fmt: skip
+    result["articles_per_s"] = num_articles / result["seconds"]
+    return result
+
+
+def print_results(results: list[dict]):
+    print(
+        f"{'scale':>7} {'benchmark':<28} {'seconds':>8} {'rate/s':>9} {'p50':>6} {'p99':>6} {'rss MiB':>8}"
+    )
+    for result in results:
+        rate = result.get("images_per_s", result.get("articles_per_s"))
+        print(
+            f"{result['scale']:>7} {result['benchmark']:<28} {result['seconds']:>8.2f} {rate:>9.1f} "
+            f"{result.get('p50') or '-':>6} {result.get('p99') or '-':>6} {result['peak_rss_mib']:>8.1f}"
+            + ("" if result["returncode"] == 0 else f"  (exit code {result['returncode']})")
+        )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    scales = [int(scale) for scale in args.scales.split(",")]
+    concurrencies = [int(value) for value in args.concurrency.split(",")]
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    server = start_mock_server(args)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    results = []
+    try:
+        for scale in scales:
+            scale_dir = workdir / f"scale-{scale}"
+            if scale_dir.exists():
+                shutil.rmtree(scale_dir)
+            scale_dir.mkdir()
+            metadata = scale_dir / "bench.metadata"
+            generate_metadata(
+                metadata, scale, args.imgs_per_article, base_url, args.seed
+            )
+
+            for max_concurrency in concurrencies:
+                result = bench_download_asyncio(
+                    scale_dir, metadata, scale, max_concurrency, args.host_rate
+                )
+                results.append(
+                    {"scale": scale, "benchmark": f"download_asyncio c={max_concurrency}", **result}
+                )
+
+            result, download_dir = bench_multiprocess_download(
+                scale_dir, metadata, args.maxproc
+            )
+            results.append(
+                {"scale": scale, "benchmark": f"multiprocess_download p={args.maxproc}", **result}
+            )
+
+            result = bench_postprocess(download_dir, args.maxproc, scale)
+            results.append(
+                {"scale": scale, "benchmark": f"postprocess p={args.maxproc}", **result}
+            )
+    finally:
+        server.terminate()
+        server.wait()
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import sqlite3
+import uuid
+from pathlib import Path
+
+URL_CACHE_FILENAME = "url_cache.sqlite3"
+
+
+def link_file(src: Path, dst: Path):
+    """Place a file at `dst` as a hardlink of `src`, falling back to a copy across filesystems. Any existing file at
+    `dst` is replaced atomically, unless it already is `src`.
+
+    Args:
+        src (Path): Path of the file
+        dst (Path): Path to place it at
+    """
+    # renaming over a hardlink of the same file does nothing, and would leave the temporary link behind
+    if dst.exists() and src.samefile(dst):
+        return
+
+    tmp_path = dst.with_name(dst.name + ".part")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class BlobStore:
+    """Content addressed store of downloaded images, shared by all articles and languages.
+
+    Every distinct image body is kept once, as `blobs/<first 2 hex digits>/<sha256>`, and a URL cache maps each
+    downloaded URL to its blob. Article files are hardlinks to the blobs (copies when the article directory is on
+    another filesystem), so an image repeated across articles or language services is fetched and stored once.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.blob_dir = root / "blobs"
+        self.tmp_dir = root / "tmp"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(exist_ok=True)
+
+        self.conn = sqlite3.connect(str(root / URL_CACHE_FILENAME), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def get_blob_path(self, digest: str) -> Path:
+        return self.blob_dir / digest[:2] / digest
+
+    def new_tmp_path(self) -> Path:
+        """Unique path to download a body to, on the same filesystem as the blobs."""
+        return self.tmp_dir / uuid.uuid4().hex
+
+    def lookup(self, url: str) -> Path | None:
+        """Find the blob of a URL that was already downloaded.
+
+        Args:
+            url (str): Image URL
+
+        Returns:
+            Path | None: Path to the blob, None if the URL was never downloaded or its blob is gone
+        """
+        row = self.conn.execute(
+            "SELECT digest FROM urls WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        blob_path = self.get_blob_path(row[0])
+        return blob_path if blob_path.exists() else None
+
+    def add(self, url: str, tmp_path: Path, digest: str) -> Path:
+        """Move a downloaded body into the store and remember its URL. If the same content is already stored under
+        another URL, the new copy is dropped.
+
+        Args:
+            url (str): Image URL the body was downloaded from
+            tmp_path (Path): Downloaded body, from `new_tmp_path`
+            digest (str): SHA-256 hex digest of the body
+
+        Returns:
+            Path: Path to the blob
+        """
+        blob_path = self.get_blob_path(digest)
+        size = tmp_path.stat().st_size
+        if blob_path.exists():
+            tmp_path.unlink()
+        else:
+            blob_path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, blob_path)
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls (url, digest, size) VALUES (?, ?, ?)",
+                (url, digest, size),
+            )
+        return blob_path
+
+    def link(self, blob_path: Path, filepath: Path):
+        """Place a blob at `filepath` as a hardlink, falling back to a copy across filesystems. Any existing file at
+        `filepath` is replaced atomically.
+
+        Args:
+            blob_path (Path): Path to the blob
+            filepath (Path): Path of the article's image file
+        """
+        link_file(blob_path, filepath)
+
+    def close(self):
+        self.conn.close()
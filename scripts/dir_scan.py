@@ -0,0 +1,96 @@
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+# a directory modified this recently may still change within the same mtime tick, its listing is not cached
+RACY_SECONDS = 2
+
+
+def iter_subdirs(path: Path, counts: dict | None = None) -> Iterator[str]:
+    """Stream the names of the subdirectories of `path` in a single `os.scandir` pass. Entry types come from the
+    directory listing itself (`d_type`), so no file is stat'ed. Hidden entries are left out.
+
+    Args:
+        path (Path): Directory to scan
+        counts (dict | None, optional): If given, `"dirs"` is set to the number of subdirectories, hidden included,
+            once the scan completes. Defaults to None.
+
+    Yields:
+        str: Subdirectory names, in directory order
+    """
+    num_dirs = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                num_dirs += 1
+                if not entry.name.startswith("."):
+                    yield entry.name
+    if counts is not None:
+        counts["dirs"] = num_dirs
+
+
+def get_scan_cache_path(img_dir: Path) -> Path:
+    # next to the directory, so writing the cache does not change the directory's own mtime
+    return img_dir.parent / f".{img_dir.name}.dirs"
+
+
+def read_scan_cache(img_dir: Path, dir_stat: os.stat_result) -> list[str] | None:
+    cache_path = get_scan_cache_path(img_dir)
+    try:
+        with cache_path.open() as f:
+            mtime_ns, nlink = map(int, f.readline().split())
+            names = f.read().splitlines()
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # a renamed, or an added and a removed article directory change the mtime but not the link count, so only the
+    # mtime decides. The link count is checked on top when it was reliable (not 0) when the cache was written
+    if dir_stat.st_mtime_ns != mtime_ns:
+        return None
+    if nlink > 0 and dir_stat.st_nlink != nlink:
+        return None
+    return names
+
+
+def write_scan_cache(img_dir: Path, mtime_ns: int, nlink: int, names: list[str]):
+    cache_path = get_scan_cache_path(img_dir)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        f.write(f"{mtime_ns} {nlink}\n")
+        f.writelines(f"{name}\n" for name in names)
+    os.replace(tmp_path, cache_path)
+
+
+def list_article_dirs(img_dir: Path, use_cache: bool = True) -> list[str]:
+    """List the article directories of a language image directory.
+
+    The listing is cached in `.<lang>.dirs` next to the directory. It stays valid while the directory's mtime is
+    unchanged, and, on filesystems where a directory's link count is 2 plus its number of subdirectories (ext4, XFS,
+    NFS exports of them), its link count too. Any entry added to, removed from or renamed in the directory changes
+    its mtime, so the next listing scans it again. The download stage refreshes it once a run completes, and the
+    following postprocessing run reuses it instead of listing a directory of hundreds of thousands of articles
+    again.
+
+    Args:
+        img_dir (Path): Language image directory
+        use_cache (bool, optional): Read and refresh the cached listing. Defaults to True.
+
+    Returns:
+        list[str]: Names (Article Ids) of the article directories
+    """
+    dir_stat = img_dir.stat()
+    if use_cache:
+        names = read_scan_cache(img_dir, dir_stat)
+        if names is not None:
+            return names
+
+    counts = {}
+    names = list(iter_subdirs(img_dir, counts))
+    if use_cache:
+        # the link count is only trusted if it matched the scan
+        nlink = dir_stat.st_nlink if dir_stat.st_nlink == counts["dirs"] + 2 else 0
+        # a directory modified within the same mtime tick as the scan could change without its mtime changing
+        is_racy = time.time_ns() - dir_stat.st_mtime_ns < RACY_SECONDS * 10**9
+        write_scan_cache(img_dir, -1 if is_racy else dir_stat.st_mtime_ns, nlink, names)
+    return names
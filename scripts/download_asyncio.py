@@ -1,13 +1,22 @@
 import asyncio
 import aiohttp
-from pathlib import Path, PurePath
-import json
+from pathlib import Path
+import hashlib
 import os
+import time
 from tqdm import tqdm
 from urllib.parse import urlparse
-import tenacity
 import aiofiles
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from metadata_index import count_articles
+from download_journal import JOURNAL_FILENAME, DownloadJournal, JournalStatus
+from rate_limiter import HostRateLimiter, parse_retry_after
+from blob_store import BlobStore, link_file
+from image_probe import PROBE_BYTES, is_filter_size, probe_image_header
+from download_metrics import DownloadMetrics, classify_error
+from retry_queue import RetryQueue
+from download_plan import TaskKind, load_plan_slice
 
 ################################## argument parsing ###########################################
 parser = argparse.ArgumentParser()
@@ -36,30 +45,195 @@ parser.add_argument(
     "--max-retry",
     type=int,
     default=5,
-    help="Maximum retry count if file download fails",
+    help="Maximum number of attempts of a failed image download, retried later from the retry queue",
+)
+parser.add_argument(
+    "--retry-delay",
+    type=float,
+    default=1,
+    help="Base seconds of the exponential backoff between attempts, doubled with every attempt and jittered",
+)
+parser.add_argument(
+    "--max-retry-delay",
+    type=float,
+    default=60,
+    help="Longest backoff between attempts, in seconds",
+)
+parser.add_argument(
+    "--retry-exceptions",
+    action="store_true",
+    help="Instead of a metadata slice, retry the images the journal of `--download-dir` records as failed",
+)
+parser.add_argument(
+    "--error-classes",
+    type=str,
+    default=None,
+    help="Comma separated error classes (e.g. `timeout,http_500`) `--retry-exceptions` is limited to, all but 4xx other than 408/429 and `invalid_url` if not given",
 )
 parser.add_argument(
     "--timeout", type=int, default=600, help="Timeout for download request, in seconds"
 )
+parser.add_argument(
+    "--max-concurrency",
+    type=int,
+    default=64,
+    help="Maximum number of image requests in flight at once, shared by all articles",
+)
+parser.add_argument(
+    "--per-article-concurrency",
+    type=int,
+    default=8,
+    help="Maximum number of images of a single article downloaded at once, 1 downloads them one by one",
+)
+parser.add_argument(
+    "--host-rate",
+    type=float,
+    default=10,
+    help="Initial number of requests per second to a single host, adapted to the host's throttling",
+)
+parser.add_argument(
+    "--min-host-rate",
+    type=float,
+    default=0.5,
+    help="Lowest number of requests per second to a single host when backing off",
+)
+parser.add_argument(
+    "--max-host-rate",
+    type=float,
+    default=100,
+    help="Highest number of requests per second to a single host when ramping up",
+)
+parser.add_argument(
+    "--limit-per-host",
+    type=int,
+    default=0,
+    help="Maximum number of pooled connections to a single host, 0 for no per-host limit",
+)
+parser.add_argument(
+    "--keepalive-timeout",
+    type=int,
+    default=30,
+    help="Seconds an idle pooled connection is kept alive for reuse",
+)
+parser.add_argument(
+    "--max-bytes",
+    type=int,
+    default=0,
+    help="Abort downloads larger than this many bytes, 0 for no limit",
+)
+parser.add_argument(
+    "--blob-store",
+    type=str,
+    default=None,
+    help="Directory of the content addressed image store shared across articles and languages, disabled if not given",
+)
+parser.add_argument(
+    "--early-filter",
+    action="store_true",
+    help="Read image dimensions from the first bytes of the download, and abort images postprocessing would filter",
+)
+parser.add_argument(
+    "--metrics-file",
+    type=str,
+    default=None,
+    help="Append a JSON line of download metrics (per-host latency, throughput, errors) to this file periodically",
+)
+parser.add_argument(
+    "--metrics-interval",
+    type=float,
+    default=10,
+    help="Seconds between metrics snapshots written to `--metrics-file`",
+)
 parser.add_argument("--quiet", action="store_true", help="Don't print progressbar")
 
-args = parser.parse_args()
 
-DOWNLOAD_DIR = Path(args.download_dir)
-METADATA_FILE = Path(args.metadata)
+def configure(args: argparse.Namespace):
+    """Set the download settings of this process. When run as a script they come from the command line, processes
+    that import this module (e.g. the workers of `multiprocess_download.py`) start from the defaults and pass in
+    their own.
 
-START_IDX = args.start_idx
-END_IDX = args.end_idx
-STEP = args.step
-MAX_RETRY = args.max_retry
-TIMEOUT = args.timeout
-QUIET = args.quiet
+    Args:
+        args (argparse.Namespace): Arguments parsed by `parser`
+    """
+    global DOWNLOAD_DIR, METADATA_FILE, START_IDX, END_IDX, STEP, MAX_RETRY, TIMEOUT
+    global RETRY_DELAY, MAX_RETRY_DELAY, RETRY_EXCEPTIONS, ERROR_CLASSES
+    global MAX_CONCURRENCY, PER_ARTICLE_CONCURRENCY, LIMIT_PER_HOST, KEEPALIVE_TIMEOUT
+    global HOST_RATE, MIN_HOST_RATE, MAX_HOST_RATE, MAX_BYTES, BLOB_STORE, EARLY_FILTER
+    global METRICS_FILE, METRICS_INTERVAL, QUIET
+
+    DOWNLOAD_DIR = Path(args.download_dir)
+    METADATA_FILE = Path(args.metadata)
+
+    START_IDX = args.start_idx
+    END_IDX = args.end_idx
+    STEP = args.step
+    MAX_RETRY = args.max_retry
+    RETRY_DELAY = args.retry_delay
+    MAX_RETRY_DELAY = args.max_retry_delay
+    RETRY_EXCEPTIONS = args.retry_exceptions
+    ERROR_CLASSES = args.error_classes.split(",") if args.error_classes else None
+    TIMEOUT = args.timeout
+    MAX_CONCURRENCY = args.max_concurrency
+    PER_ARTICLE_CONCURRENCY = args.per_article_concurrency
+    LIMIT_PER_HOST = args.limit_per_host
+    KEEPALIVE_TIMEOUT = args.keepalive_timeout
+    HOST_RATE = args.host_rate
+    MIN_HOST_RATE = args.min_host_rate
+    MAX_HOST_RATE = args.max_host_rate
+    MAX_BYTES = args.max_bytes
+    BLOB_STORE = Path(args.blob_store) if args.blob_store else None
+    EARLY_FILTER = args.early_filter
+    METRICS_FILE = Path(args.metrics_file) if args.metrics_file else None
+    METRICS_INTERVAL = args.metrics_interval
+    QUIET = args.quiet
+
+
+configure(parser.parse_args() if __name__ == "__main__" else parser.parse_args([]))
 ############################################################################################
 
 # there are 320722 articles
-article_slice = slice(START_IDX, END_IDX, STEP)
-
 progress_bar: tqdm
+request_semaphore: asyncio.Semaphore
+rate_limiter: HostRateLimiter
+journal_executor: ThreadPoolExecutor  # the single thread every journal of this process is opened and used on
+journals: dict[Path, asyncio.Future]  # download dir -> its journal, opened on `journal_executor`
+blob_executor: ThreadPoolExecutor  # the single thread the blob store of this process is opened and used on
+blob_store: BlobStore | None
+blob_fetches: dict[str, asyncio.Task]  # URL -> download into the blob store in flight
+url_fetches: dict[str, tuple[Path, asyncio.Task]]  # URL -> file and download of an article not yet recorded
+metrics: DownloadMetrics
+retry_queue: RetryQueue
+retry_counts: dict[str, int]  # images pushed to the retry queue, and how many of them a retry downloaded
+
+# statuses with which a host tells us to slow down
+THROTTLE_STATUSES = (429, 503)
+# client errors worth another attempt, any other 4xx status will not change on retry
+RETRYABLE_CLIENT_STATUSES = (408, 429)
+CHUNK_SIZE = 64 * 1024
+# subdirectories of an article that postprocessing moves its images into
+SORTED_SUBDIRS = ("USEFUL", "FILTERED", "CORRUPT")
+# keys of a download task recorded in the journal
+METADATA_KEYS = ("Id", "Image Path", "Article Id", "Article URL", "Article Index", "Image URL")
+
+
+class ResponseStatusError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"Response was not 200: {status}")
+        self.status = status
+
+
+class PayloadTooLargeError(Exception):
+    def __init__(self, nbytes: int):
+        super().__init__(f"Payload exceeds {MAX_BYTES} bytes: {nbytes}")
+        self.nbytes = nbytes
+
+
+class FilteredImageError(Exception):
+    def __init__(self, img_format: str, width: int, height: int):
+        super().__init__(f"Filtered by its header: {img_format} {width}x{height}")
+        self.img_format = img_format
+        self.width = width
+        self.height = height
 
 
 def get_base_url(url: str) -> str:
@@ -68,197 +242,719 @@ def get_base_url(url: str) -> str:
     return base_url
 
 
-def read_metadata_file(path: Path) -> list[dict]:
-    """Read metadata file, where each line contains a JSON. These JSONs are converted to pytho dicts,
-    and a list of dicts is returned.
-
-    Args:
-        path (Path): Path to metadata file. File should contain a JSON in each line.
+def create_session() -> aiohttp.ClientSession:
+    """Create the single `aiohttp` session shared by every article of this run. The pooled connector keeps
+    connections alive between requests, so consecutive images from the same host reuse an open connection instead
+    of paying a new TCP/TLS handshake each time.
 
     Returns:
-        list[dict]: List of JSONs in the metadata file, converted to List of Dictionaries.
+        aiohttp.ClientSession: Client session backed by a pooled connector
     """
-    with path.open() as f:
-        lines = f.readlines()
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY,
+        limit_per_host=LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+        ssl=False,
+    )
+    return aiohttp.ClientSession(connector=connector, trust_env=True)
+
 
-    return [json.loads(line) for line in lines]
+def init_download_state():
+    """Create the shared state of this process' event loop: the global request limit, the per-host rate limiter,
+    the journals of the download directories, the blob store, the metrics and the retry queue. Has to be called
+    inside the running event loop.
+    """
+    global request_semaphore, rate_limiter, journal_executor, journals, blob_executor, blob_store, blob_fetches
+    global url_fetches, metrics, retry_queue, retry_counts
+    request_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    rate_limiter = HostRateLimiter(HOST_RATE, MIN_HOST_RATE, MAX_HOST_RATE)
+    journal_executor = ThreadPoolExecutor(max_workers=1)
+    journals = {}
+    blob_executor = ThreadPoolExecutor(max_workers=1)
+    blob_store = (
+        blob_executor.submit(BlobStore, BLOB_STORE).result() if BLOB_STORE is not None else None
+    )
+    blob_fetches = {}
+    url_fetches = {}
+    metrics = DownloadMetrics(METRICS_FILE, METRICS_INTERVAL)
+    metrics.start()
+    retry_queue = RetryQueue(retry_fetch, MAX_RETRY, RETRY_DELAY, MAX_RETRY_DELAY)
+    retry_queue.start()
+    retry_counts = {"Retried": 0, "Recovered": 0}
+
+
+async def run_journal(func, *args):
+    """Run a journal call on `journal_executor`. Several processes write to the journal of a language, so a call can
+    wait on their lock, which would stall every download of the event loop if it ran on it.
+    """
+    return await asyncio.get_running_loop().run_in_executor(journal_executor, func, *args)
 
 
-@tenacity.retry(
-    reraise=True,
-    stop=tenacity.stop_after_attempt(MAX_RETRY),
-    wait=tenacity.wait_random(min=3, max=10),
-)
-async def download_img(session: aiohttp.ClientSession, url: str, filepath: Path):
-    """Downloads the file from the provided URL asynchronously.
+async def run_blob_store(func, *args):
+    """Run a blob store call on `blob_executor`. Its URL cache is shared by the processes of every language, so like
+    the journals, a call can wait on their lock.
+    """
+    return await asyncio.get_running_loop().run_in_executor(blob_executor, func, *args)
+
+
+async def get_journal(download_dir: Path) -> DownloadJournal:
+    if download_dir not in journals:
+        journals[download_dir] = asyncio.ensure_future(
+            run_journal(DownloadJournal, download_dir / JOURNAL_FILENAME)
+        )
+    return await journals[download_dir]
+
+
+async def commit_journal(journal: DownloadJournal):
+    # records are buffered on the event loop, and written by the journal's thread
+    await run_journal(journal.write, journal.take_pending())
+
+
+def close_download_state():
+    retry_queue.close()
+
+    for journal in journals.values():
+        journal_executor.submit(journal.result().close).result()
+    journals.clear()
+    journal_executor.shutdown()
+
+    if blob_store is not None:
+        blob_executor.submit(blob_store.close).result()
+    blob_executor.shutdown()
+
+    metrics.close()
+
+
+async def download_img(
+    session: aiohttp.ClientSession, url: str, host: str, filepath: Path
+):
+    """Downloads the file from the provided URL asynchronously, in a single attempt. Failed downloads are retried
+    later through the `retry_queue`.
+
+    With a `blob_store`, a URL that was downloaded before, by any article or language, is linked from the store
+    instead of fetched again. Concurrent downloads of the same URL share a single request.
 
     Args:
         session (aiohttp.ClientSession): `aiohttp` Client session to connect to URL
         url (str): URL to the downloadable binary
+        host (str): Base URL of `url`, the key of its rate limit and metrics
         filepath (Path): Path to save the downloaded content
     """
-    async with session.get(url, ssl=False) as response:
-        if response.status != 200:
-            raise Exception("Response was not 200")
+    if blob_store is None:
+        await request_img(session, url, host, filepath)
+        return
+
+    blob_path = await run_blob_store(blob_store.lookup, url)
+    if blob_path is None:
+        if url not in blob_fetches:
+            blob_fetches[url] = asyncio.ensure_future(fetch_blob(session, url, host))
+        blob_path = await asyncio.shield(blob_fetches[url])
+
+    blob_store.link(blob_path, filepath)
+
+
+async def fetch_blob(session: aiohttp.ClientSession, url: str, host: str) -> Path:
+    """Download a URL into the blob store.
+
+    Args:
+        session (aiohttp.ClientSession): `aiohttp` Client session to connect to URL
+        url (str): URL to the downloadable binary
+        host (str): Base URL of `url`
+
+    Returns:
+        Path: Path to the blob
+    """
+    tmp_path = blob_store.new_tmp_path()
+    try:
+        digest = await request_img(session, url, host, tmp_path, digest=True)
+        return await run_blob_store(blob_store.add, url, tmp_path, digest)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        del blob_fetches[url]
+
+
+async def request_img(
+    session: aiohttp.ClientSession,
+    url: str,
+    host: str,
+    filepath: Path,
+    digest: bool = False,
+) -> str | None:
+    """Downloads the file from the provided URL asynchronously, in a single attempt.
+
+    Requests are paced by the per-host `rate_limiter`. A 429/503 response or a reset connection makes the limiter
+    back off from the host (honouring `Retry-After`), a successful download lets it ramp back up. The latency, size
+    or error class of every request is recorded in `metrics`.
 
-        async with aiofiles.open(str(filepath), "wb") as f:
-            await f.write(await response.read())
+    Args:
+        session (aiohttp.ClientSession): `aiohttp` Client session to connect to URL
+        url (str): URL to the downloadable binary
+        host (str): Base URL of `url`, resolved by the download plan, the key of its rate limit and metrics
+        filepath (Path): Path to save the downloaded content
+        digest (bool, optional): Whether to compute the SHA-256 digest of the content. Defaults to False.
+
+    Returns:
+        str | None: Hex digest of the content, if requested
+    """
+    # waiting for the host's rate limit or a free request slot
+    metrics.queued += 1
+    try:
+        await rate_limiter.acquire(host)
+        await request_semaphore.acquire()
+    finally:
+        metrics.queued -= 1
+
+    metrics.in_flight += 1
+    start = time.monotonic()
+    try:
+        async with session.get(
+            url, timeout=aiohttp.ClientTimeout(total=TIMEOUT)
+        ) as response:
+            if response.status in THROTTLE_STATUSES:
+                rate_limiter.throttle(
+                    host, start, parse_retry_after(response.headers.get("Retry-After"))
+                )
+            if response.status != 200:
+                raise ResponseStatusError(response.status)
+            rate_limiter.success(host)
+
+            if MAX_BYTES and (response.content_length or 0) > MAX_BYTES:
+                raise PayloadTooLargeError(response.content_length)
+
+            hexdigest, nbytes = await stream_to_file(response, filepath, digest)
+    except FilteredImageError:
+        # the host answered fine, only the image is unwanted
+        metrics.observe_request(host, time.monotonic() - start, 0)
+        raise
+    except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+        # connection dropped or reset by the host, not one that could not be opened (DNS failure, refused)
+        if not isinstance(e, aiohttp.ClientConnectorError):
+            rate_limiter.throttle(host, start)
+        metrics.observe_error(host, time.monotonic() - start, e)
+        raise
+    except Exception as e:
+        metrics.observe_error(host, time.monotonic() - start, e)
+        raise
+    finally:
+        metrics.in_flight -= 1
+        request_semaphore.release()
+
+    metrics.observe_request(host, time.monotonic() - start, nbytes)
+    return hexdigest
+
+
+async def stream_to_file(
+    response: aiohttp.ClientResponse, filepath: Path, digest: bool = False
+) -> tuple[str | None, int]:
+    """Stream the response body to disk in chunks, so only one chunk per request is held in memory. The body is
+    written to `<name>.part` and renamed to `filepath` once complete, so `filepath` never holds a partial download.
+
+    With `EARLY_FILTER`, the dimensions are read from the image header as soon as the first bytes arrive, and the
+    transfer is aborted with `FilteredImageError` if postprocessing would filter the image.
 
+    Args:
+        response (aiohttp.ClientResponse): Response to read the body of
+        filepath (Path): Path to save the downloaded content
+        digest (bool, optional): Whether to compute the SHA-256 digest of the body. Defaults to False.
 
-def is_skip_link(imgurl: str) -> bool:
-    """Skip download link if it is not an image format file.
+    Returns:
+        tuple[str | None, int]: Hex digest of the body, if requested, and its size in bytes
+    """
+    tmp_path = filepath.with_name(filepath.name + ".part")
+    hasher = hashlib.sha256() if digest else None
+    nbytes = 0
+    header = b""
+    probing = EARLY_FILTER
+    try:
+        async with aiofiles.open(str(tmp_path), "wb") as f:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                nbytes += len(chunk)
+                if MAX_BYTES and nbytes > MAX_BYTES:
+                    raise PayloadTooLargeError(nbytes)
+                if probing:
+                    header += chunk
+                    probed = probe_image_header(header)
+                    if probed is not None and is_filter_size(probed[1], probed[2]):
+                        raise FilteredImageError(*probed)
+                    probing = probed is None and len(header) < PROBE_BYTES
+                if hasher is not None:
+                    hasher.update(chunk)
+                await f.write(chunk)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    return hasher.hexdigest() if hasher is not None else None, nbytes
+
+
+def is_download_complete(
+    img_path: Path,
+    data: dict,
+    journal_entry: tuple[JournalStatus, str, str | None, int | None] | None,
+) -> bool:
+    """Whether the journal records this image as finished, so it is not requested again: either downloaded, with the
+    file still intact on disk, where it was downloaded to or sorted into by postprocessing, or filtered by its header
+    in a run that still filters early. Without `EARLY_FILTER` filtered images are downloaded, as postprocessing may
+    keep them.
 
     Args:
-        imgurl (str): Image URL
+        img_path (Path): Path the image is downloaded to
+        data (dict): Image metadata
+        journal_entry (tuple[JournalStatus, str, str | None, int | None] | None): (status, URL, path, size) recorded
+            in the journal, if any
 
     Returns:
-        bool: Should this download link be skipped
+        bool: Whether the download can be skipped
     """
-    return (
-        imgurl.endswith((".html", ".svg"))
-        or imgurl.startswith(
-            (
-                "https://platform.twitter.com",
-                "https://www.facebook.com",
-                "https://www.youtube.com",
-            )
-        )
-        or any(
-            substr in imgurl
-            for substr in [
-                "iframe.html",
-                "?",
-            ]
-        )
-    )
+    if journal_entry is None:
+        return False
 
+    status, url, path, size = journal_entry
+    if url != data["Image URL"]:
+        return False
+    if status == JournalStatus.FILTERED:
+        return EARLY_FILTER
+    if path != data["Image Path"]:
+        return False
+    return find_downloaded_file(img_path, size) is not None
 
-def write_dict_to_json_file(json_file: Path, data_dicts: list[dict]):
-    """Write data dict to JSON file.
+
+def find_downloaded_file(img_path: Path, size: int | None) -> Path | None:
+    """Find a downloaded image where it was downloaded to, or sorted into by postprocessing.
 
     Args:
-        json_file (Path): JSON file path
-        data_dicts (list[dict]): List of dictionaries
+        img_path (Path): Path the image was downloaded to
+        size (int | None): Size of the download, recorded in the journal, None if it could not be read, in which case
+            any file at one of the paths counts
+
+    Returns:
+        Path | None: Path of the image file, None if it is gone or no file has its size
+    """
+    # postprocessing moves images into a subdirectory of their article
+    for candidate_path in (
+        img_path,
+        *(img_path.parent / subdir / img_path.name for subdir in SORTED_SUBDIRS),
+    ):
+        try:
+            if size is None or candidate_path.stat().st_size == size:
+                return candidate_path
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def link_duplicate(
+    img_path: Path,
+    data: dict,
+    original_entry: tuple[JournalStatus, str, str | None, int | None] | None,
+    download_dir: Path,
+) -> bool:
+    """Place the image downloaded by the first task of its URL at `img_path`, as a hardlink or a copy, instead of
+    fetching the URL again. A URL repeated within an article has the same path as its first task, whose image is
+    already in place, wherever postprocessing sorted it to, and is not linked again.
+
+    Args:
+        img_path (Path): Path to download the image to
+        data (dict): Image metadata
+        original_entry (tuple[JournalStatus, str, str | None, int | None] | None): (status, URL, path, size) the
+            journal records for the first task of the URL, if any
+        download_dir (Path): Download directory of the image's language
+
+    Returns:
+        bool: Whether the image was placed, False if the first task's image is not downloaded (yet)
     """
-    with json_file.open("w") as f:
-        json.dump(data_dicts, f, indent=2)
+    if original_entry is None:
+        return False
+
+    status, url, path, size = original_entry
+    if status != JournalStatus.DONE or url != data["Image URL"] or path is None:
+        return False
+
+    original_path = find_downloaded_file(download_dir / path, size)
+    if original_path is None:
+        return False
+    if path == data["Image Path"]:
+        return True
+    try:
+        link_file(original_path, img_path)
+    except OSError:
+        return False
+    return True
 
 
-async def download_article_media(article: dict):
-    """Download all the media of the provided article. Assign ID to each image, and map to it's article and
-    relative position in the article.
+def is_permanent_status(status: int) -> bool:
+    return 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUSES
 
-    Each downloaded media is stored in a directory named by it's article ID. Each directory consists of the media
-    files and metadata files. The images that were successfully downloaded have their metadata in
-    `successful_metadata.json`, and the images that failed for some reason have their metadata in
-    `exceptions_metadata.json` for each article.
+
+def is_retryable(exception: BaseException) -> bool:
+    if isinstance(exception, ResponseStatusError):
+        return not is_permanent_status(exception.status)
+    # an empty or malformed URL (`aiohttp.InvalidURL` is a `ValueError`) fails the same way on every attempt
+    return not isinstance(exception, (PayloadTooLargeError, FilteredImageError, ValueError))
+
+
+def record_download(
+    journal: DownloadJournal,
+    data: dict,
+    download_dir: Path,
+    exception: BaseException | None,
+) -> JournalStatus:
+    """Record the outcome of a download attempt of an image in the journal.
+
+    Args:
+        journal (DownloadJournal): Journal of the image's language
+        data (dict): Image metadata
+        download_dir (Path): Download directory of the image's language
+        exception (BaseException | None): Exception the download failed with, None if it succeeded
+
+    Returns:
+        JournalStatus: Recorded status
+    """
+    if exception is None:
+        try:
+            size = (download_dir / data["Image Path"]).stat().st_size
+        except FileNotFoundError:
+            # a later link of the article wrote to the same file and failed
+            size = None
+        journal.record(data, JournalStatus.DONE, size)
+        return JournalStatus.DONE
+
+    if isinstance(exception, FilteredImageError):
+        # never fully downloaded, only the header was read
+        data = {
+            **data,
+            "Image Path": None,
+            "Image Format": exception.img_format,
+            "Image Width": exception.width,
+            "Image Height": exception.height,
+        }
+        journal.record(data, JournalStatus.FILTERED)
+        return JournalStatus.FILTERED
+
+    data = {
+        **data,
+        "Exception": f"[Exception]: {str(exception)}",
+        "Error Class": classify_error(exception),
+    }
+    journal.record(data, JournalStatus.FAILED)
+    return JournalStatus.FAILED
+
+
+async def retry_fetch(retry: dict, attempt: int) -> bool:
+    """Download attempt of an image taken off the `retry_queue`, its outcome is recorded in the journal.
+
+    Args:
+        retry (dict): `{"session", "url", "host", "path", "download_dir", "records"}`, the records being the metadata
+            of every link of the article downloaded to `path` from `url`
+        attempt (int): Number of this attempt, the first one was made by the article
+
+    Returns:
+        bool: Whether the image is finished, False if it failed and may be retried
+    """
+    metrics.observe_retry(retry["host"])
+    journal = await get_journal(retry["download_dir"])
+    try:
+        await download_img(retry["session"], retry["url"], retry["host"], retry["path"])
+        exception = None
+    except Exception as e:
+        exception = e
+
+    try:
+        for data in retry["records"]:
+            record_download(journal, data, retry["download_dir"], exception)
+    except Exception as e:
+        # the downloaded file could not be read back, the images are recorded as failed with that error instead of
+        # the exception getting lost in the retry queue
+        exception = e
+        for data in retry["records"]:
+            record_download(journal, data, retry["download_dir"], exception)
+    await commit_journal(journal)
+
+    if exception is None:
+        retry_counts["Recovered"] += len(retry["records"])
+    return exception is None or not is_retryable(exception)
+
+
+def push_retry(
+    session: aiohttp.ClientSession,
+    url: str,
+    host: str,
+    path: Path,
+    download_dir: Path,
+    records: list[dict],
+    attempts: int = 1,
+    delay: float | None = None,
+):
+    retry = {
+        "session": session,
+        "url": url,
+        "host": host,
+        "path": path,
+        "download_dir": download_dir,
+        "records": records,
+    }
+    if retry_queue.push(retry, attempts, delay):
+        retry_counts["Retried"] += len(records)
+
+
+async def download_article_media(
+    session: aiohttp.ClientSession,
+    article_id: str,
+    tasks: list[dict],
+    download_dir: Path,
+) -> dict:
+    """Download all the media of the provided article, planned by `download_plan`: every task has the image's ID,
+    its article and relative position in it, its resolved URL and host, its file path, unique within the article, and
+    the ID of the first task of the metadata file fetching the same URL, if any.
+
+    Each downloaded media is stored in a directory named by it's article ID, inside `download_dir`. The metadata of
+    every image, successfully downloaded or not, is recorded in the journal of `download_dir` (one SQLite file per
+    language), committed once per article on the journal's own thread, instead of metadata files in each article
+    directory.
 
     - Has to be a stateless function for parallelism
+    - Every image request holds `request_semaphore`, which caps in-flight requests across all articles, and is paced
+    by the per-host `rate_limiter`
+    - Up to `PER_ARTICLE_CONCURRENCY` images of the article are downloaded at once
+    - With `EARLY_FILTER`, images whose header fails the filtration criterions are not downloaded, their format and
+    dimensions are recorded as `FILTERED`
+    - Images the journal records as downloaded, whose file is still on disk, are not downloaded again, nor are
+    images it records as filtered while `EARLY_FILTER` is on
+    - An image whose URL an earlier article already downloaded, or is downloading in this process, is linked from
+    that article's file instead of fetched again. If that article's image was filtered by its header, this one is
+    recorded as `FILTERED` with the same header
+    - Failed downloads are recorded as `FAILED` and handed to the `retry_queue`, the article does not wait for their
+    retries, which record their own outcome
 
     Args:
-        article (dict): Dictionary with article metadata
+        session (aiohttp.ClientSession): Shared client session of this run
+        article_id (str): Article Id
+        tasks (list[dict]): Download tasks of the article's links, see `download_plan.plan_articles`
+        download_dir (Path): Download directory of the article's language
+
+    Returns:
+        dict: Number of successful, exception, skipped and filtered images of the article
     """
-    successful_img_list = []
-    exceptions_img_list = []
-    skipped_links = []
-
-    article_dir = Path(article["id"])
-    article_dir.mkdir(exist_ok=True)
-
-    article_base_url = get_base_url(article["url"])
-
-    # iterate over each media of this article
-    async with aiohttp.ClientSession(trust_env=True) as session:
-        for idx, img_url in enumerate(article["media_links"]):
-            if img_url and img_url[0] == "/":
-                # double //
-                img_url = img_url[1:] if img_url[1] == "/" else img_url
-                img_url = article_base_url + img_url
-
-            # getting image file name
-            img_name = PurePath(img_url).name
-
-            # image metadata to be stored
-            data = {
-                "Id": f"{article['id']}_{idx}",
-                "Image Path": str(article_dir / img_name),
-                "Article Id": article["id"],
-                "Article URL": article["url"],
-                "Article Index": idx,
-                "Image URL": img_url,
-            }
-
-            if is_skip_link(img_url):
-                skipped_links.append(data)
-                continue
+    num_successful = 0
+    num_exceptions = 0
+    num_skipped = 0
+    num_filtered = 0
 
+    journal = await get_journal(download_dir)
+    (download_dir / article_id).mkdir(exist_ok=True)
+    article_semaphore = asyncio.Semaphore(PER_ARTICLE_CONCURRENCY)
+
+    async def fetch(img_url: str, host: str, img_path: Path):
+        async with article_semaphore:
             try:
-                _ = await asyncio.wait_for(
-                    download_img(session, img_url, article_dir / img_name), TIMEOUT
-                )
-                successful_img_list.append(data)
+                await download_img(session, img_url, host, img_path)
             except Exception as e:
                 # download failed for some reason
-                try:
-                    # delete partially downloaded file if any
-                    Path(data["Image Path"]).unlink(missing_ok=True)
-                except:
-                    pass
-
-                data["Exception"] = f"[Exception]: {str(e)}"
-                exceptions_img_list.append(data)
-
-    write_dict_to_json_file(
-        article_dir / "successful_metadata.json", successful_img_list
+                return e
+
+    async def fetch_duplicate(img_url: str, host: str, img_path: Path):
+        # wait for the article downloading the URL, and fetch it here only if that download failed
+        original_path, original_fetch = url_fetches[img_url]
+        original_result = await asyncio.shield(original_fetch)
+        if isinstance(original_result, FilteredImageError):
+            # same header, filtered the same way
+            return original_result
+        if original_result is None:
+            try:
+                link_file(original_path, img_path)
+                return None
+            except OSError:
+                pass
+        return await fetch(img_url, host, img_path)
+
+    download_links = []  # (metadata, download task) in article order
+    path_tasks: dict[Path, tuple[str, str, asyncio.Task]] = {}
+    # journal entries of the article's images, and of the first images of the URLs it repeats
+    completed = await run_journal(
+        journal.completed,
+        [task["Id"] for task in tasks]
+        + [task["Duplicate Of"] for task in tasks if task["Duplicate Of"] is not None],
+    )
+    # headers of the first images that were filtered, in a run that still filters early their duplicates are filtered
+    # without a request
+    filtered_originals = await run_journal(
+        journal.filtered_headers,
+        [
+            task["Duplicate Of"]
+            for task in tasks
+            if EARLY_FILTER and task["Duplicate Of"] in completed
+        ],
     )
 
-    if len(exceptions_img_list) > 0:
-        write_dict_to_json_file(
-            article_dir / "exceptions_metadata.json", exceptions_img_list
-        )
-
-    if len(skipped_links) > 0:
-        write_dict_to_json_file(article_dir / "skipped_links.json", skipped_links)
+    for task in tasks:
+        # image metadata to be stored, metadata paths are relative to the download dir
+        data = {key: task[key] for key in METADATA_KEYS}
+
+        if task["Task"] == TaskKind.SKIP:
+            num_skipped += 1
+            # recording it again would bump its update time, and postprocessing would classify the article again
+            journal_entry = completed.get(data["Id"])
+            if journal_entry is None or journal_entry[:2] != (JournalStatus.SKIPPED, data["Image URL"]):
+                journal.record(data, JournalStatus.SKIPPED)
+            continue
+
+        img_path = download_dir / data["Image Path"]
+        journal_entry = completed.get(data["Id"])
+        if is_download_complete(img_path, data, journal_entry):
+            if journal_entry[0] == JournalStatus.FILTERED:
+                num_filtered += 1
+            else:
+                num_successful += 1
+            continue
+
+        if task["Duplicate Of"] is not None and link_duplicate(
+            img_path, data, completed.get(task["Duplicate Of"]), download_dir
+        ):
+            record_download(journal, data, download_dir, None)
+            num_successful += 1
+            continue
+
+        original_header = filtered_originals.get(task["Duplicate Of"])
+        if original_header is not None and completed[task["Duplicate Of"]][1] == data["Image URL"]:
+            # the first image of the URL was filtered by its header, this one would be too
+            record_download(journal, data, download_dir, FilteredImageError(*original_header))
+            num_filtered += 1
+            continue
+
+        if img_path not in path_tasks:
+            # a URL repeated in the article has the same path, the file is only downloaded once
+            img_url = data["Image URL"]
+            if task["Duplicate Of"] is not None and url_fetches.get(img_url, (img_path,))[0] != img_path:
+                fetch_task = asyncio.ensure_future(fetch_duplicate(img_url, task["Host"], img_path))
+            else:
+                fetch_task = asyncio.ensure_future(fetch(img_url, task["Host"], img_path))
+                url_fetches.setdefault(img_url, (img_path, fetch_task))
+            path_tasks[img_path] = (img_url, task["Host"], fetch_task)
+        download_links.append((data, path_tasks[img_path][2]))
+
+    _ = await asyncio.gather(*(fetch_task for _, _, fetch_task in path_tasks.values()))
+
+    failed_links: dict[asyncio.Task, list[dict]] = {}
+    for data, fetch_task in download_links:
+        exception = fetch_task.result()
+        status = record_download(journal, data, download_dir, exception)
+        if status == JournalStatus.DONE:
+            num_successful += 1
+        elif status == JournalStatus.FILTERED:
+            num_filtered += 1
+        else:
+            num_exceptions += 1
+            if is_retryable(exception):
+                failed_links.setdefault(fetch_task, []).append(data)
+    await commit_journal(journal)
+
+    # later articles find the downloads of this one in the journal
+    for img_url, _, fetch_task in path_tasks.values():
+        if url_fetches.get(img_url, (None, None))[1] is fetch_task:
+            del url_fetches[img_url]
+
+    for img_path, (img_url, host, fetch_task) in path_tasks.items():
+        if fetch_task in failed_links:
+            push_retry(
+                session, img_url, host, img_path, download_dir, failed_links[fetch_task]
+            )
 
     if not QUIET:
         progress_bar.update()
 
+    return {
+        "Article Id": article_id,
+        "Successful": num_successful,
+        "Exceptions": num_exceptions,
+        "Skipped": num_skipped,
+        "Filtered": num_filtered,
+    }
+
 
 async def main():
     print(f"Download from {START_IDX} to {END_IDX}...")
-    metadata = read_metadata_file(METADATA_FILE)
-    total_articles = len(metadata)
+    # tasks of the slice, from the metadata's download plan (planned now if there is none)
+    article_tasks = load_plan_slice(METADATA_FILE, START_IDX, END_IDX, STEP)
+    total_articles = count_articles(METADATA_FILE)
     print(f"metadata read, there are {total_articles} articles")
 
     # downloads will be placed in this directory
     DOWNLOAD_DIR.mkdir(exist_ok=True)
-    os.chdir(DOWNLOAD_DIR)
-
-    metadata_slice = metadata[article_slice]
 
     if not QUIET:
         global progress_bar
         nrows = 8
         pos = ((START_IDX // 500) % nrows) + 1
         progress_bar = tqdm(
-            total=len(metadata_slice),
+            total=len(article_tasks),
             desc=f"[{START_IDX}, {END_IDX})",
             position=pos,
             leave=False,
             dynamic_ncols=True,
         )
 
-    tasks = []
-    for article in metadata_slice:
-        task = asyncio.ensure_future(download_article_media(article))
-        tasks.append(task)
+    init_download_state()
 
-    await asyncio.gather(*tasks)
+    # one pooled session for the whole slice, connections are reused across articles
+    async with create_session() as session:
+        tasks = []
+        for article_id, img_tasks in article_tasks:
+            task = asyncio.ensure_future(
+                download_article_media(session, article_id, img_tasks, DOWNLOAD_DIR)
+            )
+            tasks.append(task)
+
+        await asyncio.gather(*tasks)
+        # failed images are retried after their articles finished
+        await retry_queue.drain()
+
+    close_download_state()
 
     if not QUIET:
         progress_bar.close()
 
 
+async def retry_exceptions():
+    """Retry the images the journal of `DOWNLOAD_DIR` records as failed (of `ERROR_CLASSES` only, if given, else all
+    but permanent client errors like `http_404` and `invalid_url`), without going through their articles again. Each
+    gets up to `MAX_RETRY` attempts from the retry queue.
+    """
+    journal = DownloadJournal(DOWNLOAD_DIR / JOURNAL_FILENAME)
+    # images that failed with a permanent client error or an invalid URL are only retried when asked for by class
+    permanent_error_classes = [
+        f"http_{status}" for status in range(400, 500) if is_permanent_status(status)
+    ] + ["invalid_url"]
+    records = journal.failed_records(
+        ERROR_CLASSES, None if ERROR_CLASSES is not None else permanent_error_classes
+    )
+    journal.close()
+
+    # links of an article repeating a URL share one download
+    downloads: dict[tuple[str, str], list[dict]] = {}
+    for data in records:
+        downloads.setdefault((data["Image URL"], data["Image Path"]), []).append(data)
+    print(f"Retrying {len(downloads)} downloads of {len(records)} failed images...")
+
+    init_download_state()
+    async with create_session() as session:
+        for (img_url, img_path), img_records in downloads.items():
+            push_retry(
+                session,
+                img_url,
+                get_base_url(img_url),
+                DOWNLOAD_DIR / img_path,
+                DOWNLOAD_DIR,
+                img_records,
+                attempts=0,
+                delay=0,
+            )
+        await retry_queue.drain()
+    print(f"Downloaded {retry_counts['Recovered']} of {len(records)} failed images")
+    close_download_state()
+
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(retry_exceptions() if RETRY_EXCEPTIONS else main())
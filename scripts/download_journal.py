@@ -0,0 +1,302 @@
+import sqlite3
+import time
+from enum import Enum
+from pathlib import Path
+
+JOURNAL_FILENAME = "download_journal.sqlite3"
+
+
+class JournalStatus(Enum):
+    DONE = "DONE"
+    FAILED = "FAILED"
+    SKIPPED = "SKIPPED"
+    FILTERED = "FILTERED"
+
+
+# image metadata keys, as in the former per-article JSON metadata files, and the journal column of each
+METADATA_COLUMNS = {
+    "Id": "image_id",
+    "Image URL": "image_url",
+    "Image Path": "image_path",
+    "Article Id": "article_id",
+    "Article URL": "article_url",
+    "Article Index": "article_idx",
+    "Exception": "exception",
+    "Error Class": "error_class",
+    "Image Format": "image_format",
+    "Image Width": "image_width",
+    "Image Height": "image_height",
+}
+
+# keys only set for failed or filtered images
+OPTIONAL_METADATA_KEYS = (
+    "Exception",
+    "Error Class",
+    "Image Format",
+    "Image Width",
+    "Image Height",
+)
+
+class DownloadJournal:
+    """Durable per-image record of the downloads of one language directory, kept in a SQLite file inside it.
+
+    Every image that was attempted has a row with its metadata (URL, path relative to the download directory, article
+    and position in it), file size, status, and the exception or header dimensions of failed and filtered images. It
+    is the only metadata store of a language, so the downloader writes no per-article files and postprocessing reads
+    each article's rows through the `article_id` index. Several download processes can share the journal of a
+    language, SQLite serializes their writes. Records are buffered and written in one transaction on `commit()`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.pending: list[tuple] = []
+
+        self.conn = sqlite3.connect(str(path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                image_id TEXT PRIMARY KEY,
+                image_url TEXT NOT NULL,
+                image_path TEXT,
+                size INTEGER,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                article_id TEXT,
+                article_url TEXT,
+                article_idx INTEGER,
+                exception TEXT,
+                error_class TEXT,
+                image_format TEXT,
+                image_width INTEGER,
+                image_height INTEGER
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS images_article_id ON images (article_id)"
+        )
+        # articles classified by postprocessing, with the latest image update they saw
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS postprocessed (
+                article_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def completed(
+        self, image_ids: list[str]
+    ) -> dict[str, tuple[JournalStatus, str, str | None, int | None]]:
+        """Look up the images that were already downloaded, filtered by their header, or skipped.
+
+        Args:
+            image_ids (list[str]): Image Ids to look up
+
+        Returns:
+            dict[str, tuple[JournalStatus, str, str | None, int | None]]: Image Id to (status, URL, path, size) of
+                each finished image
+        """
+        if len(image_ids) == 0:
+            return {}
+
+        placeholders = ",".join("?" * len(image_ids))
+        rows = self.conn.execute(
+            f"""
+            SELECT image_id, status, image_url, image_path, size FROM images
+            WHERE status IN (?, ?, ?) AND image_id IN ({placeholders})
+            """,
+            (
+                JournalStatus.DONE.value,
+                JournalStatus.FILTERED.value,
+                JournalStatus.SKIPPED.value,
+                *image_ids,
+            ),
+        )
+        return {
+            image_id: (JournalStatus(status), url, path, size)
+            for image_id, status, url, path, size in rows
+        }
+
+    def filtered_headers(self, image_ids: list[str]) -> dict[str, tuple[str, int, int]]:
+        """Look up the header of the images that were filtered by it.
+
+        Args:
+            image_ids (list[str]): Image Ids to look up
+
+        Returns:
+            dict[str, tuple[str, int, int]]: Image Id to (format, width, height) of each filtered image
+        """
+        if len(image_ids) == 0:
+            return {}
+
+        placeholders = ",".join("?" * len(image_ids))
+        rows = self.conn.execute(
+            f"""
+            SELECT image_id, image_format, image_width, image_height FROM images
+            WHERE status = ? AND image_id IN ({placeholders})
+            """,
+            (JournalStatus.FILTERED.value, *image_ids),
+        )
+        return {
+            image_id: (img_format, width, height)
+            for image_id, img_format, width, height in rows
+        }
+
+    def article_records(self, article_id: str) -> dict[JournalStatus, list[dict]]:
+        """Read the metadata of an article's images, grouped by status.
+
+        Args:
+            article_id (str): Article Id
+
+        Returns:
+            dict[JournalStatus, list[dict]]: Status to the metadata of its images in `Article Index` order, keyed as
+                `METADATA_COLUMNS`, `OPTIONAL_METADATA_KEYS` only when set. Empty lists if the article has no records
+        """
+        keys = list(METADATA_COLUMNS)
+        columns = ", ".join(METADATA_COLUMNS.values())
+        rows = self.conn.execute(
+            f"""
+            SELECT status, {columns} FROM images
+            WHERE article_id = ? ORDER BY article_idx
+            """,
+            (article_id,),
+        )
+
+        records = {status: [] for status in JournalStatus}
+        for status, *values in rows:
+            records[JournalStatus(status)].append(
+                {
+                    key: value
+                    for key, value in zip(keys, values)
+                    if value is not None or key not in OPTIONAL_METADATA_KEYS
+                }
+            )
+        return records
+
+    def failed_records(
+        self,
+        error_classes: list[str] | None = None,
+        exclude_error_classes: list[str] | None = None,
+    ) -> list[dict]:
+        """Read the metadata of the images whose download failed, to download them again.
+
+        Args:
+            error_classes (list[str] | None, optional): Only images that failed with these error classes. Defaults
+                to None, all failed images.
+            exclude_error_classes (list[str] | None, optional): Leave out images that failed with these error
+                classes. Defaults to None.
+
+        Returns:
+            list[dict]: Metadata of the failed images, keyed as `METADATA_COLUMNS` without `OPTIONAL_METADATA_KEYS`
+        """
+        keys = [key for key in METADATA_COLUMNS if key not in OPTIONAL_METADATA_KEYS]
+        columns = ", ".join(METADATA_COLUMNS[key] for key in keys)
+        query = f"SELECT {columns} FROM images WHERE status = ?"
+        params = [JournalStatus.FAILED.value]
+        if error_classes is not None:
+            query += f" AND error_class IN ({','.join('?' * len(error_classes))})"
+            params += error_classes
+        if exclude_error_classes is not None:
+            query += (
+                " AND (error_class IS NULL OR error_class NOT IN"
+                f" ({','.join('?' * len(exclude_error_classes))}))"
+            )
+            params += exclude_error_classes
+        rows = self.conn.execute(query + " ORDER BY article_id, article_idx", params)
+        return [dict(zip(keys, values)) for values in rows]
+
+    def count_failed_articles(self) -> int:
+        """Number of articles with at least one image whose download failed."""
+        return self.conn.execute(
+            "SELECT COUNT(DISTINCT article_id) FROM images WHERE status = ?",
+            (JournalStatus.FAILED.value,),
+        ).fetchone()[0]
+
+    def article_updates(self) -> dict[str, float]:
+        """Time of the latest image record of every article in the journal.
+
+        Returns:
+            dict[str, float]: Article Id to the latest `updated_at` of its images
+        """
+        rows = self.conn.execute(
+            """
+            SELECT article_id, MAX(updated_at) FROM images
+            WHERE article_id IS NOT NULL GROUP BY article_id
+            """
+        )
+        return dict(rows)
+
+    def postprocessed_articles(self) -> dict[str, float]:
+        """Articles already classified by postprocessing.
+
+        Returns:
+            dict[str, float]: Article Id to the latest image update it was classified with
+        """
+        return dict(self.conn.execute("SELECT article_id, updated_at FROM postprocessed"))
+
+    def mark_postprocessed(self, article_updates: dict[str, float]):
+        """Record articles as classified by postprocessing.
+
+        Args:
+            article_updates (dict[str, float]): Article Id to the latest image update it was classified with
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO postprocessed (article_id, updated_at) VALUES (?, ?)",
+                article_updates.items(),
+            )
+
+    def clear_postprocessed(self):
+        """Forget every classified article, e.g. before classifying all of them again."""
+        with self.conn:
+            self.conn.execute("DELETE FROM postprocessed")
+
+    def record(self, data: dict, status: JournalStatus, size: int | None = None):
+        """Buffer the outcome of an image, it is persisted on the next `commit()`.
+
+        Args:
+            data (dict): Image metadata, with the keys of `METADATA_COLUMNS`. `Id` is `<article id>_<article index>`
+                and `Image Path` is relative to the download directory
+            status (JournalStatus): Outcome of the download
+            size (int | None, optional): File size in bytes, if downloaded. Defaults to None.
+        """
+        self.pending.append(
+            (
+                *(data.get(key) for key in METADATA_COLUMNS),
+                size,
+                status.value,
+                time.time(),
+            )
+        )
+
+    def take_pending(self) -> list[tuple]:
+        """Hand over the buffered records, to be written with `write()`, e.g. from another thread."""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def write(self, rows: list[tuple]):
+        """Persist records taken with `take_pending()` in one transaction."""
+        if len(rows) == 0:
+            return
+
+        columns = [*METADATA_COLUMNS.values(), "size", "status", "updated_at"]
+        placeholders = ", ".join("?" * len(columns))
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                INSERT OR REPLACE INTO images ({", ".join(columns)})
+                VALUES ({placeholders})
+                """,
+                rows,
+            )
+
+    def commit(self):
+        self.write(self.take_pending())
+
+    def close(self):
+        self.commit()
+        self.conn.close()
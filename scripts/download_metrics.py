@@ -0,0 +1,198 @@
+import asyncio
+import bisect
+import errno
+import json
+import os
+import socket
+import time
+from pathlib import Path
+import aiohttp
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# event loop lag is sampled by sleeping this long and measuring the overshoot
+LOOP_LAG_INTERVAL = 0.1
+
+
+def classify_error(exception: BaseException) -> str:
+    """Class of a failed request, for the error counters: `timeout`, `dns`, `refused`, `reset`, `ssl`,
+    `http_<status>` for non-200 responses, `payload` for truncated bodies, `invalid_url` for empty or malformed URLs,
+    the exception name otherwise.
+
+    Args:
+        exception (BaseException): Exception raised by the request
+
+    Returns:
+        str: Error class
+    """
+    if isinstance(exception, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exception, aiohttp.ClientSSLError):
+        return "ssl"
+    if isinstance(exception, aiohttp.ClientConnectorError):
+        if isinstance(exception.os_error, socket.gaierror):
+            return "dns"
+        if isinstance(exception.os_error, ConnectionRefusedError):
+            return "refused"
+    if isinstance(exception, aiohttp.ServerDisconnectedError) or (
+        isinstance(exception, aiohttp.ClientOSError)
+        and exception.errno in (errno.ECONNRESET, errno.EPIPE)
+    ):
+        return "reset"
+    if isinstance(exception, aiohttp.ClientPayloadError):
+        return "payload"
+    if isinstance(exception, aiohttp.InvalidURL):
+        return "invalid_url"
+
+    status = getattr(exception, "status", None)
+    if isinstance(status, int):
+        return f"http_{status}"
+    return type(exception).__name__
+
+
+class Histogram:
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile, None if nothing was observed (or it falls in the
+        unbounded bucket)."""
+        if self.total == 0:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self) -> dict:
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.total,
+            "mean": self.sum / self.total if self.total else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class HostMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.requests = 0
+        self.bytes = 0
+        self.transfer_seconds = 0.0
+        self.retries = 0
+        self.errors: dict[str, int] = {}
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "bytes_per_s": (
+                self.bytes / self.transfer_seconds if self.transfer_seconds else None
+            ),
+            "retries": self.retries,
+            "errors": self.errors,
+            "latency": self.latency.to_dict(),
+        }
+
+
+class DownloadMetrics:
+    """In-process telemetry of the downloads of one event loop.
+
+    Per host: request latency histogram, bytes and bytes/s of successful downloads, retries and error counts by
+    `classify_error` class. Across hosts: requests in flight, requests queued for the rate limiter or the global
+    request limit, and the lag of the event loop, which tells a slow server or network apart from a busy loop.
+    Counters are cumulative. With a metrics file, a snapshot is appended to it as a JSON line every `interval`
+    seconds, and once more on `close()`.
+    """
+
+    def __init__(self, metrics_file: Path | None = None, interval: float = 10):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.started = time.monotonic()
+        self.hosts: dict[str, HostMetrics] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.loop_lag = Histogram((0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+        self.max_loop_lag = 0.0
+        self.tasks: list[asyncio.Task] = []
+
+    def get_host(self, host: str) -> HostMetrics:
+        if host not in self.hosts:
+            self.hosts[host] = HostMetrics()
+        return self.hosts[host]
+
+    def observe_request(self, host: str, seconds: float, nbytes: int):
+        host_metrics = self.get_host(host)
+        host_metrics.requests += 1
+        host_metrics.latency.observe(seconds)
+        host_metrics.bytes += nbytes
+        host_metrics.transfer_seconds += seconds
+
+    def observe_error(self, host: str, seconds: float, exception: BaseException):
+        host_metrics = self.get_host(host)
+        host_metrics.requests += 1
+        host_metrics.latency.observe(seconds)
+        error_class = classify_error(exception)
+        host_metrics.errors[error_class] = host_metrics.errors.get(error_class, 0) + 1
+
+    def observe_retry(self, host: str):
+        self.get_host(host).retries += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time(),
+            "pid": os.getpid(),
+            "elapsed": time.monotonic() - self.started,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "loop_lag": {**self.loop_lag.to_dict(), "max": self.max_loop_lag},
+            "hosts": {host: metrics.to_dict() for host, metrics in self.hosts.items()},
+        }
+
+    def export(self):
+        if self.metrics_file is None:
+            return
+        with self.metrics_file.open("a") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+    async def sample_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(lag)
+            self.max_loop_lag = max(self.max_loop_lag, lag)
+
+    async def export_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.export()
+
+    def start(self):
+        """Start sampling the event loop lag and exporting. Has to be called inside the running event loop."""
+        self.tasks.append(asyncio.ensure_future(self.sample_loop_lag()))
+        if self.metrics_file is not None:
+            self.tasks.append(asyncio.ensure_future(self.export_periodically()))
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+        self.export()
@@ -0,0 +1,343 @@
+import argparse
+import os
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from metadata_index import count_articles, iter_metadata_file, read_metadata_slice
+
+# sidecar plan of a metadata file, `<name>.metadata.plan.parquet`
+PLAN_SUFFIX = ".plan.parquet"
+PLAN_ROW_GROUP_SIZE = 64 * 1024
+# bumped whenever planning changes, plans of an older version are rebuilt
+PLAN_VERSION = "2"
+# articles planned at once when building the plan of a whole metadata file
+PLAN_CHUNK_ARTICLES = 50_000
+
+# links that are not image files: embedded pages and players
+SKIP_SUFFIXES = (".html", ".svg")
+SKIP_PREFIXES = (
+    "https://platform.twitter.com",
+    "https://www.facebook.com",
+    "https://www.youtube.com",
+)
+SKIP_SUBSTRINGS = ("iframe.html", "?")
+SKIP_LINK_PATTERN = "|".join(
+    [
+        *(re.escape(suffix) + "$" for suffix in SKIP_SUFFIXES),
+        *("^" + re.escape(prefix) for prefix in SKIP_PREFIXES),
+        *(re.escape(substr) for substr in SKIP_SUBSTRINGS),
+    ]
+)
+BASE_URL_PATTERN = r"^([A-Za-z][A-Za-z0-9+.-]*://[^/?#]*)"
+
+
+class TaskKind:
+    FETCH = "FETCH"  # image to download
+    SKIP = "SKIP"  # link that is not an image, only recorded
+    EMPTY = "EMPTY"  # placeholder of an article without links
+
+
+# task columns, named as the image metadata keys of the journal, and the planning columns
+PLAN_SCHEMA = pa.schema(
+    [
+        ("Article Row", pa.int64()),  # line of the article in the metadata file
+        ("Task", pa.string()),
+        ("Id", pa.string()),
+        ("Article Id", pa.string()),
+        ("Article URL", pa.string()),
+        ("Article Index", pa.int64()),
+        ("Image URL", pa.string()),
+        ("Image Path", pa.string()),
+        ("Host", pa.string()),
+        ("Duplicate Of", pa.string()),  # Id of the first task fetching the same URL
+    ]
+)
+
+
+def get_file_names(urls: pd.Series) -> pd.Series:
+    # `PurePath(url).name`
+    return urls.str.rstrip("/").str.rsplit("/", n=1).str[-1]
+
+
+def assign_file_names(links: pd.DataFrame) -> pd.Series:
+    """File names of the links, made unique within each article. Links of an article repeating a
+    URL share its file, a different URL whose name is taken gets `<stem>_<k><suffix>`.
+
+    Args:
+        links (pd.DataFrame): Links, with `Article Row` and normalized `Image URL`
+
+    Returns:
+        pd.Series: File name of every link
+    """
+    urls = links[["Article Row", "Image URL"]].assign(Name=get_file_names(links["Image URL"]))
+    unique_urls = urls.drop_duplicates(["Article Row", "Image URL"])
+
+    while True:
+        # the k-th distinct URL of an article with a name gets suffix k
+        k = unique_urls.groupby(["Article Row", "Name"]).cumcount()
+        if not (k > 0).any():
+            break
+        parts = unique_urls["Name"].str.extract(r"^(.*?)(\.[^.]*)?$")
+        renamed = parts[0] + "_" + k.astype(str) + parts[1].fillna("")
+        unique_urls = unique_urls.assign(Name=unique_urls["Name"].where(k == 0, renamed))
+
+    return urls[["Article Row", "Image URL"]].merge(
+        unique_urls, on=["Article Row", "Image URL"], how="left"
+    )["Name"].set_axis(links.index)
+
+
+def find_duplicates(plan: pd.DataFrame) -> pd.Series:
+    """Id of the first task fetching the same URL of every `FETCH` task repeating a URL, missing otherwise."""
+    is_fetch = plan["Task"] == TaskKind.FETCH
+    first_ids = (
+        plan["Id"].where(is_fetch).groupby(plan["Image URL"].where(is_fetch)).transform("first")
+    )
+    return first_ids.where(is_fetch & (first_ids != plan["Id"]))
+
+
+def plan_articles(articles: list[dict], article_rows: list[int]) -> pd.DataFrame:
+    """Turn articles of a metadata file into download tasks in one vectorized pass: relative links are resolved
+    against the article URL, links that are empty or not images are marked `SKIP`, every image gets a collision free
+    file name in its article directory, and repeated URLs point to the first task fetching them.
+
+    Args:
+        articles (list[dict]): Articles of the metadata file
+        article_rows (list[int]): Line of every article in the metadata file
+
+    Returns:
+        pd.DataFrame: Tasks in article and link order, columns of `PLAN_SCHEMA`. Articles without links have a single
+            `EMPTY` task
+    """
+    links = pd.DataFrame(
+        {
+            "Article Row": article_rows,
+            "Article Id": [article["id"] for article in articles],
+            "Article URL": [article["url"] for article in articles],
+            "Image URL": [article["media_links"] for article in articles],
+        }
+    )
+    num_links = links["Image URL"].str.len()
+    links = links.explode("Image URL", ignore_index=False)
+    links["Article Index"] = links.groupby(level=0).cumcount()
+    links = links.reset_index(drop=True)
+    is_empty = (num_links == 0).to_numpy()[
+        np.repeat(np.arange(len(articles)), np.maximum(num_links.to_numpy(), 1))
+    ]
+
+    # links relative to the article's host: `/path`, or `//path` which loses one of its slashes
+    urls = links["Image URL"].fillna("").astype(str)
+    is_relative = urls.str.startswith("/")
+    article_base_urls = links["Article URL"].str.extract(BASE_URL_PATTERN)[0].fillna("")
+    urls = urls.where(
+        ~is_relative,
+        article_base_urls + urls.where(~urls.str.startswith("//"), urls.str[1:]),
+    )
+    links["Image URL"] = urls
+
+    # an empty or missing link has nothing to fetch, and no file name or host
+    is_skip = (urls == "") | urls.str.contains(SKIP_LINK_PATTERN)
+    links["Task"] = np.where(
+        is_empty,
+        TaskKind.EMPTY,
+        np.where(is_skip, TaskKind.SKIP, TaskKind.FETCH),
+    )
+    is_fetch = links["Task"] == TaskKind.FETCH
+    links["Id"] = links["Article Id"] + "_" + links["Article Index"].astype(str)
+    # only files that are downloaded need a unique name
+    names = get_file_names(urls).where(~is_fetch, assign_file_names(links[is_fetch]))
+    links["Image Path"] = links["Article Id"] + "/" + names
+    links["Host"] = urls.str.extract(BASE_URL_PATTERN)[0]
+
+    links["Duplicate Of"] = find_duplicates(links)
+
+    for column in ("Id", "Image URL", "Image Path", "Host", "Article Index"):
+        links[column] = links[column].where(~is_empty, None)
+    return links[PLAN_SCHEMA.names]
+
+
+def plan_to_table(plan: pd.DataFrame) -> pa.Table:
+    return pa.Table.from_pandas(plan, schema=PLAN_SCHEMA, preserve_index=False)
+
+
+def get_plan_path(path: Path) -> Path:
+    return path.with_name(path.name + PLAN_SUFFIX)
+
+
+def is_plan_fresh(path: Path) -> bool:
+    """Whether the sidecar plan exists and was built from the current version of the metadata file.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        bool: Whether the plan can be used as is
+    """
+    plan_path = get_plan_path(path)
+    if not plan_path.exists():
+        return False
+
+    mdata_stat = path.stat()
+    metadata = pq.read_schema(plan_path).metadata or {}
+    if metadata.get(b"plan_version") != PLAN_VERSION.encode():
+        return False
+    return metadata.get(b"metadata_size") == str(mdata_stat.st_size).encode() and metadata.get(
+        b"metadata_mtime_ns"
+    ) == str(mdata_stat.st_mtime_ns).encode()
+
+
+def build_plan(path: Path) -> Path:
+    """Plan the downloads of a whole metadata file, and store the task table in a sidecar Parquet file next to it
+    (`<name>.metadata.plan.parquet`). Repeated URLs are detected across the whole file. The plan is written to a
+    temporary file first and renamed in place.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        Path: Path to the sidecar plan
+    """
+    mdata_stat = path.stat()
+    chunks = []
+    articles, rows = [], []
+    for row, article in enumerate(iter_metadata_file(path)):
+        articles.append(article)
+        rows.append(row)
+        if len(articles) == PLAN_CHUNK_ARTICLES:
+            chunks.append(plan_articles(articles, rows))
+            articles, rows = [], []
+    if len(articles) > 0 or len(chunks) == 0:
+        chunks.append(plan_articles(articles, rows))
+    plan = pd.concat(chunks, ignore_index=True)
+
+    # repeated URLs across chunks
+    plan["Duplicate Of"] = find_duplicates(plan)
+
+    table = plan_to_table(plan).replace_schema_metadata(
+        {
+            "plan_version": PLAN_VERSION,
+            "metadata_size": str(mdata_stat.st_size),
+            "metadata_mtime_ns": str(mdata_stat.st_mtime_ns),
+        }
+    )
+    plan_path = get_plan_path(path)
+    tmp_path = plan_path.with_name(f"{plan_path.name}.{os.getpid()}.tmp")
+    pq.write_table(table, tmp_path, row_group_size=PLAN_ROW_GROUP_SIZE)
+    os.replace(tmp_path, plan_path)
+
+    return plan_path
+
+
+def ensure_plan(path: Path) -> Path:
+    """Build the sidecar plan unless an up to date one already exists.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        Path: Path to the sidecar plan
+    """
+    if is_plan_fresh(path):
+        return get_plan_path(path)
+    return build_plan(path)
+
+
+def read_plan(path: Path) -> pd.DataFrame:
+    return pq.read_table(ensure_plan(path)).to_pandas()
+
+
+def summarize_plan(plan: pd.DataFrame) -> dict:
+    """Size of the planned workload.
+
+    Returns:
+        dict: Numbers of articles, links, skipped links, images to fetch, distinct URLs among them, and images per host
+    """
+    fetch = plan[plan["Task"] == TaskKind.FETCH]
+    return {
+        "Articles": int(plan["Article Row"].nunique()),
+        "Links": int((plan["Task"] != TaskKind.EMPTY).sum()),
+        "Skipped": int((plan["Task"] == TaskKind.SKIP).sum()),
+        "Fetch": len(fetch),
+        "Unique URLs": int(fetch["Duplicate Of"].isna().sum()),
+        "Hosts": fetch["Host"].value_counts().to_dict(),
+    }
+
+
+def group_tasks(plan: pd.DataFrame) -> list[tuple[str, list[dict]]]:
+    """Split a plan into the tasks of each article.
+
+    Args:
+        plan (pd.DataFrame): Tasks, in article order
+
+    Returns:
+        list[tuple[str, list[dict]]]: (Article Id, tasks) of every article, tasks as dictionaries keyed by column
+    """
+    plan = plan.astype(object).where(plan.notna(), None)
+    articles = []
+    for task in plan.to_dict("records"):
+        if len(articles) == 0 or articles[-1][0] != task["Article Row"]:
+            articles.append((task["Article Row"], task["Article Id"], []))
+        if task["Task"] != TaskKind.EMPTY:
+            # nullable integer column, read back as float
+            task["Article Index"] = int(task["Article Index"])
+            articles[-1][2].append(task)
+    return [(article_id, tasks) for _, article_id, tasks in articles]
+
+
+def load_plan_slice(
+    path: Path, start: int | None, end: int | None, step: int | None = 1
+) -> list[tuple[str, list[dict]]]:
+    """Tasks of the articles `metadata[start:end:step]`. They are read from the sidecar plan if it is up to date,
+    reading only its row groups of the slice, otherwise the articles of the slice are planned on the spot.
+
+    Args:
+        path (Path): Path to metadata file
+        start (int | None): Starting index of article list slice
+        end (int | None): Ending index of article list slice
+        step (int | None, optional): Step size of article list slice. Defaults to 1.
+
+    Returns:
+        list[tuple[str, list[dict]]]: (Article Id, tasks) of every article of the slice, see `group_tasks`
+    """
+    indices = range(count_articles(path))[slice(start, end, step)]
+    if len(indices) == 0:
+        return []
+
+    if is_plan_fresh(path):
+        plan = pq.read_table(
+            get_plan_path(path),
+            filters=[
+                ("Article Row", ">=", min(indices)),
+                ("Article Row", "<=", max(indices)),
+            ],
+        ).to_pandas()
+        if indices.step != 1:
+            plan = plan[plan["Article Row"].isin(indices)]
+    else:
+        articles = read_metadata_slice(path, start, end, step)
+        plan = plan_articles(articles, list(indices))
+    return group_tasks(plan)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "metadata", type=str, nargs="+", help="Metadata files to plan the downloads of"
+    )
+    parser.add_argument(
+        "--top-hosts", type=int, default=10, help="Number of hosts with the most images to print"
+    )
+    args = parser.parse_args()
+
+    for metadata in args.metadata:
+        metadata = Path(metadata)
+        summary = summarize_plan(read_plan(metadata))
+        print(
+            f"{metadata.stem}: {summary['Articles']} articles, {summary['Links']} links, "
+            f"{summary['Skipped']} skipped, {summary['Fetch']} images to fetch from "
+            f"{summary['Unique URLs']} unique URLs and {len(summary['Hosts'])} hosts"
+        )
+        for host, count in list(summary["Hosts"].items())[: args.top_hosts]:
+            print(f"\t{host}: {count}")
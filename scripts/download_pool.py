@@ -0,0 +1,564 @@
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import queue
+import time
+from collections import deque
+from pathlib import Path
+from colorama import Fore
+from tqdm import tqdm
+import download_asyncio
+from download_plan import load_plan_slice, read_plan, summarize_plan
+from metadata_index import count_articles, ensure_line_index
+
+
+def get_batch_key(batch: dict) -> tuple[str, int]:
+    return str(batch["metadata"]), batch["start_idx"]
+
+
+async def consume_batches(session, task_queue: mp.Queue, result_queue: mp.Queue):
+    """Pull batches of articles off the worker's queue until the `None` sentinel arrives, download them, and
+    report the result of every article back to the parent.
+
+    Args:
+        session (aiohttp.ClientSession): Client session of this worker
+        task_queue (mp.Queue): Queue of batches, `{"metadata", "download_dir", "start_idx", "end_idx"}`
+        result_queue (mp.Queue): Queue of `("article", (pid, batch key, result))` and `("batch", (pid, batch))`
+            messages, and a final `("retries", counts)` message once the worker's retries finished
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await loop.run_in_executor(None, task_queue.get)
+        if batch is None:
+            return
+
+        article_tasks = load_plan_slice(
+            batch["metadata"], batch["start_idx"], batch["end_idx"]
+        )
+        results = await asyncio.gather(
+            *(
+                download_asyncio.download_article_media(
+                    session, article_id, img_tasks, batch["download_dir"]
+                )
+                for article_id, img_tasks in article_tasks
+            ),
+            return_exceptions=True,
+        )
+
+        for (article_id, _), result in zip(article_tasks, results):
+            if isinstance(result, Exception):
+                result = {
+                    "Article Id": article_id,
+                    "Error": f"[Exception]: {str(result)}",
+                }
+            result_queue.put(("article", (os.getpid(), get_batch_key(batch), result)))
+        result_queue.put(("batch", (os.getpid(), batch)))
+
+
+async def run_worker(
+    task_queue: mp.Queue, result_queue: mp.Queue, batches_per_worker: int
+):
+    download_asyncio.init_download_state()
+
+    # one pooled session per worker, shared by all the batches it pulls
+    async with download_asyncio.create_session() as session:
+        await asyncio.gather(
+            *(
+                consume_batches(session, task_queue, result_queue)
+                for _ in range(batches_per_worker)
+            )
+        )
+        # the failed images of all its batches are retried until the work queue is drained
+        await download_asyncio.retry_queue.drain()
+
+    download_asyncio.close_download_state()
+    result_queue.put(("retries", download_asyncio.retry_counts))
+
+
+def download_worker(
+    download_args: argparse.Namespace,
+    task_queue: mp.Queue,
+    result_queue: mp.Queue,
+    batches_per_worker: int,
+):
+    """Entry point of a long lived worker process, running its own event loop until the work queue is drained.
+
+    Args:
+        download_args (argparse.Namespace): Download settings, parsed by `download_asyncio.parser`
+        task_queue (mp.Queue): Queue of the batches of articles handed to this worker
+        result_queue (mp.Queue): Queue the results are reported to
+        batches_per_worker (int): Number of batches downloaded at once
+    """
+    if download_args.metrics_file:
+        # one metrics file per worker, appends of several processes to one file could interleave
+        metrics_file = Path(download_args.metrics_file)
+        download_args = argparse.Namespace(**vars(download_args))
+        download_args.metrics_file = str(
+            metrics_file.with_name(f"{metrics_file.stem}.{os.getpid()}{metrics_file.suffix}")
+        )
+    download_asyncio.configure(download_args)
+    asyncio.run(run_worker(task_queue, result_queue, batches_per_worker))
+
+
+class BatchQueue:
+    """Hands out batches of articles in the given order. Schedulers deciding the order as the download goes subclass
+    it, `run_download_workers` reports every completed batch back through `complete`.
+    """
+
+    def __init__(self, batches: list[dict]):
+        self.pending = deque(batches)
+
+    def has_pending(self) -> bool:
+        """Whether batches are left to hand out."""
+        return len(self.pending) > 0
+
+    def next_batch(self) -> dict | None:
+        """Next batch to download, None if none can be handed out right now. Once `has_pending` is false, none will
+        be again."""
+        return self.pending.popleft() if len(self.pending) > 0 else None
+
+    def complete(self, batch: dict):
+        pass
+
+
+class WorkerPool:
+    """Worker processes, each fed from its own queue, so the parent knows which batches every worker holds. A
+    worker that exits before its batches completed (killed for memory, crashed) is replaced, its batches are handed
+    out again once, and reported as failed if they take down a second worker.
+    """
+
+    def __init__(
+        self,
+        batches: BatchQueue,
+        download_args: argparse.Namespace,
+        num_workers: int,
+        batches_per_worker: int,
+    ):
+        self.batches = batches
+        self.download_args = download_args
+        self.batches_per_worker = batches_per_worker
+        self.result_queue = mp.Queue()
+        self.workers: list[tuple[mp.Process, mp.Queue]] = []
+        self.held: list[dict[tuple[str, int], dict]] = []  # batches of every worker, by batch key
+        self.holders: dict[tuple[str, int], int] = {}  # worker holding every batch in flight
+        self.requeued: deque[dict] = deque()
+        self.requeued_keys: set[tuple[str, int]] = set()
+        self.has_pending = True
+
+        for worker_idx in range(num_workers):
+            self.workers.append(self.start_worker())
+            self.held.append({})
+            self.fill(worker_idx)
+
+    def start_worker(self) -> tuple[mp.Process, mp.Queue]:
+        task_queue = mp.Queue()
+        process = mp.Process(
+            target=download_worker,
+            args=(self.download_args, task_queue, self.result_queue, self.batches_per_worker),
+        )
+        process.start()
+        return process, task_queue
+
+    @property
+    def batches_in_flight(self) -> int:
+        return len(self.holders)
+
+    def next_batch(self) -> dict | None:
+        if len(self.requeued) > 0:
+            return self.requeued.popleft()
+        if not self.has_pending:
+            return None
+        batch = self.batches.next_batch()
+        if batch is None:
+            self.has_pending = self.batches.has_pending()
+        return batch
+
+    def fill(self, worker_idx: int):
+        """Hand the worker batches until it holds `batches_per_worker`, or none are left."""
+        while len(self.held[worker_idx]) < self.batches_per_worker:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            key = get_batch_key(batch)
+            self.held[worker_idx][key] = batch
+            self.holders[key] = worker_idx
+            self.workers[worker_idx][1].put(batch)
+
+    def complete(self, batch: dict):
+        worker_idx = self.holders.pop(get_batch_key(batch))
+        del self.held[worker_idx][get_batch_key(batch)]
+        self.batches.complete(batch)
+        # a completed batch can let the scheduler hand out batches it held back, to any worker with a free slot
+        self.fill(worker_idx)
+        for other_idx in range(len(self.workers)):
+            self.fill(other_idx)
+
+    def holder_pid(self, key: tuple[str, int]) -> int | None:
+        """Process id of the worker holding the batch, None if it is not in flight."""
+        if key not in self.holders:
+            return None
+        return self.workers[self.holders[key]][0].pid
+
+    def replace_dead_workers(self) -> list[tuple[dict, bool]]:
+        """Replace the workers that exited before the download finished, and hand their batches out again.
+
+        Returns:
+            list[tuple[dict, bool]]: Batches of the exited workers, and whether each is given up on, as it was
+                handed out again once already
+        """
+        lost = []
+        for worker_idx, (process, _) in enumerate(self.workers):
+            if process.is_alive():
+                continue
+
+            print(
+                Fore.RED,
+                f"Worker {process.pid} exited with code {process.exitcode}, "
+                f"holding {len(self.held[worker_idx])} batches",
+                Fore.RESET,
+            )
+            for key, batch in self.held[worker_idx].items():
+                del self.holders[key]
+                given_up = key in self.requeued_keys
+                if given_up:
+                    self.batches.complete(batch)
+                else:
+                    self.requeued_keys.add(key)
+                    self.requeued.append(batch)
+                lost.append((batch, given_up))
+            self.held[worker_idx] = {}
+            self.workers[worker_idx] = self.start_worker()
+
+        for worker_idx in range(len(self.workers)):
+            self.fill(worker_idx)
+        return lost
+
+    def stop(self):
+        for _, task_queue in self.workers:
+            for _ in range(self.batches_per_worker):
+                task_queue.put(None)
+
+    def is_alive(self) -> bool:
+        return any(process.is_alive() for process, _ in self.workers)
+
+    def join(self):
+        for process, _ in self.workers:
+            process.join()
+
+
+def run_download_workers(
+    batches: list[dict] | BatchQueue,
+    total_articles: int,
+    download_args: argparse.Namespace,
+    num_workers: int,
+    batches_per_worker: int,
+) -> dict:
+    """Download the batches with a pool of worker processes. A worker is handed its next batch as soon as one of its
+    batches completes, so faster workers take on more of the work instead of waiting on static slices, and the next
+    batch is only picked then. Batches of a worker that exits early are downloaded again by its replacement, the
+    images the journal records as finished are not requested again.
+
+    Args:
+        batches (list[dict] | BatchQueue): Batches of articles, `{"metadata", "download_dir", "start_idx",
+            "end_idx"}`, or a scheduler handing them out
+        total_articles (int): Number of articles in all batches
+        download_args (argparse.Namespace): Download settings of the workers, parsed by `download_asyncio.parser`
+        num_workers (int): Number of worker processes
+        batches_per_worker (int): Number of batches a worker downloads at once
+
+    Returns:
+        dict: Aggregated image counts, the errors of articles that could not be downloaded, and the batches given up
+            on after taking down two workers. Images that failed in their article but were downloaded by a retry are
+            counted as `Recovered` instead of `Exceptions`
+    """
+    if not isinstance(batches, BatchQueue):
+        batches = BatchQueue(batches)
+    pool = WorkerPool(batches, download_args, num_workers, batches_per_worker)
+
+    summary = {
+        "Successful": 0,
+        "Exceptions": 0,
+        "Skipped": 0,
+        "Filtered": 0,
+        "Retried": 0,
+        "Recovered": 0,
+        "Errors": [],
+        "Failed Batches": [],
+    }
+    # article results of the batches in flight, only counted once their batch completed
+    batch_results: dict[tuple[str, int], list[dict]] = {}
+    progress_bar = tqdm(
+        total=total_articles, desc="TOTAL", colour="green", dynamic_ncols=True
+    )
+
+    last_check = time.monotonic()
+    while pool.batches_in_flight > 0:
+        if time.monotonic() - last_check > 1:
+            last_check = time.monotonic()
+            for batch, given_up in pool.replace_dead_workers():
+                # the articles a dead worker reported are reported again by the batch's next worker
+                progress_bar.update(-len(batch_results.pop(get_batch_key(batch), [])))
+                if given_up:
+                    summary["Failed Batches"].append(batch)
+                    progress_bar.update(batch["end_idx"] - batch["start_idx"])
+
+        try:
+            kind, result = pool.result_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        if kind == "article":
+            pid, key, result = result
+            # messages a dead worker sent before exiting are dropped, its batches are downloaded again
+            if pool.holder_pid(key) == pid:
+                batch_results.setdefault(key, []).append(result)
+                progress_bar.update()
+            continue
+
+        if kind == "batch":
+            pid, batch = result
+            key = get_batch_key(batch)
+            if pool.holder_pid(key) != pid:
+                continue
+            for article_result in batch_results.pop(key, []):
+                if "Error" in article_result:
+                    summary["Errors"].append(article_result)
+                    continue
+                for count in ("Successful", "Exceptions", "Skipped", "Filtered"):
+                    summary[count] += article_result[count]
+            progress_bar.set_postfix(exceptions=summary["Exceptions"], refresh=False)
+            pool.complete(batch)
+
+    progress_bar.close()
+    pool.stop()
+
+    # workers finish the retries of their failed images before they exit
+    workers_done = 0
+    while workers_done < num_workers:
+        try:
+            kind, result = pool.result_queue.get(timeout=5)
+        except queue.Empty:
+            if not pool.is_alive():
+                break
+            continue
+        if kind == "retries":
+            workers_done += 1
+            for key in ("Retried", "Recovered"):
+                summary[key] += result[key]
+    summary["Exceptions"] -= summary["Recovered"]
+    summary["Successful"] += summary["Recovered"]
+
+    pool.join()
+    return summary
+
+
+def prepare_metadata(metadata_file: Path) -> tuple[int, dict]:
+    """Index and plan a metadata file before its download.
+
+    Args:
+        metadata_file (Path): Metadata file
+
+    Returns:
+        tuple[int, dict]: Number of articles, and the summary of the download plan
+    """
+    # index the metadata once, reusing the sidecar index of an earlier run while it is fresh. Every worker then
+    # seeks straight to its own batches
+    ensure_line_index(metadata_file)
+    total_articles = count_articles(metadata_file)
+    # plan the downloads of the whole file once, workers read the tasks of their batches from the plan
+    plan_summary = summarize_plan(read_plan(metadata_file))
+    return total_articles, plan_summary
+
+
+def make_batches(
+    metadata_file: Path, download_dir: Path, total_articles: int, slice_len: int
+) -> list[dict]:
+    """Split the articles of a metadata file into batches of `slice_len` articles."""
+    return [
+        {
+            "metadata": metadata_file,
+            "download_dir": download_dir,
+            "start_idx": start_idx,
+            "end_idx": min(start_idx + slice_len, total_articles),
+        }
+        for start_idx in range(0, total_articles, slice_len)
+    ]
+
+
+def add_download_arguments(parser: argparse.ArgumentParser):
+    """Add the download settings shared by the multiprocess entry points, forwarded to the workers by
+    `make_download_args`, and the settings of the worker pool.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of the entry point
+    """
+    parser.add_argument(
+        "--max-retry",
+        type=int,
+        default=3,
+        help="Maximum retry count if file download fails",
+    )
+    parser.add_argument(
+        "--retry-delay",
+        type=float,
+        default=1,
+        help="Base seconds of the exponential backoff between attempts, doubled with every attempt and jittered",
+    )
+    parser.add_argument(
+        "--max-retry-delay",
+        type=float,
+        default=60,
+        help="Longest backoff between attempts, in seconds",
+    )
+    parser.add_argument(
+        "--slice-len",
+        type=int,
+        default=50,
+        help="Number of articles in a batch of work pulled by a worker",
+    )
+    parser.add_argument(
+        "--timeout", type=int, default=500, help="Timeout for download request, in seconds"
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of image requests in flight at once, per worker process",
+    )
+    parser.add_argument(
+        "--per-article-concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of images of a single article downloaded at once, 1 downloads them one by one",
+    )
+    parser.add_argument(
+        "--limit-per-host",
+        type=int,
+        default=0,
+        help="Maximum number of pooled connections to a single host, per worker process, 0 for no per-host limit",
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=int,
+        default=30,
+        help="Seconds an idle pooled connection is kept alive for reuse",
+    )
+    parser.add_argument(
+        "--host-rate",
+        type=float,
+        default=10,
+        help="Initial number of requests per second to a single host, shared by all worker processes",
+    )
+    parser.add_argument(
+        "--min-host-rate",
+        type=float,
+        default=0.5,
+        help="Lowest number of requests per second to a single host, shared by all worker processes",
+    )
+    parser.add_argument(
+        "--max-host-rate",
+        type=float,
+        default=100,
+        help="Highest number of requests per second to a single host, shared by all worker processes",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=0,
+        help="Abort downloads larger than this many bytes, 0 for no limit",
+    )
+    parser.add_argument(
+        "--blob-store",
+        type=str,
+        default=None,
+        help="Directory of the content addressed image store shared across articles and languages, disabled if not given",
+    )
+    parser.add_argument(
+        "--early-filter",
+        action="store_true",
+        help="Read image dimensions from the first bytes of the download, and abort images postprocessing would filter",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="Append download metrics to this file periodically, each worker writes `<stem>.<pid><suffix>` next to it",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10,
+        help="Seconds between metrics snapshots written to `--metrics-file`",
+    )
+    parser.add_argument(
+        "--maxproc",
+        type=int,
+        default=None,
+        help="Number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--batches-per-worker",
+        type=int,
+        default=2,
+        help="Number of batches a worker downloads at once, so it never idles between batches",
+    )
+
+
+def make_download_args(args: argparse.Namespace, num_workers: int) -> argparse.Namespace:
+    """Download settings of the worker processes, in the form `download_asyncio.configure` expects. Every worker
+    limits its request rate on its own, so the per-host rates are split evenly across the workers to keep the total
+    rate a host sees at the configured one.
+
+    Args:
+        args (argparse.Namespace): Arguments of the entry point, with the download settings of `download_asyncio`
+        num_workers (int): Number of worker processes
+
+    Returns:
+        argparse.Namespace: Download settings of every worker
+    """
+    download_args = [
+        "--max-retry", str(args.max_retry),
+        "--retry-delay", str(args.retry_delay),
+        "--max-retry-delay", str(args.max_retry_delay),
+        "--timeout", str(args.timeout),
+        "--max-concurrency", str(args.max_concurrency),
+        "--per-article-concurrency", str(args.per_article_concurrency),
+        "--limit-per-host", str(args.limit_per_host),
+        "--keepalive-timeout", str(args.keepalive_timeout),
+        "--host-rate", str(args.host_rate / num_workers),
+        "--min-host-rate", str(args.min_host_rate / num_workers),
+        "--max-host-rate", str(args.max_host_rate / num_workers),
+        "--max-bytes", str(args.max_bytes),
+        "--quiet",
+    ]  # fmt: skip
+    if args.blob_store:
+        download_args += ["--blob-store", args.blob_store]
+    if args.early_filter:
+        download_args.append("--early-filter")
+    if args.metrics_file:
+        download_args += [
+            "--metrics-file", args.metrics_file,
+            "--metrics-interval", str(args.metrics_interval),
+        ]  # fmt: skip
+    return download_asyncio.parser.parse_args(download_args)
+
+
+def print_summary(summary: dict):
+    """Print the failed articles and batches, and the image counts of `run_download_workers`."""
+    for error in summary["Errors"]:
+        print(Fore.RED, f"Article {error['Article Id']} failed: {error['Error']}", Fore.RESET)
+    for batch in summary["Failed Batches"]:
+        print(
+            Fore.RED,
+            f"Articles {batch['start_idx']} to {batch['end_idx']} of {batch['metadata']} failed: "
+            "the workers downloading them exited",
+            Fore.RESET,
+        )
+    print(
+        f"Images downloaded: {summary['Successful']}, "
+        f"skipped: {summary['Skipped']}, "
+        f"filtered early: {summary['Filtered']}, "
+        f"with exceptions: {summary['Exceptions']}, "
+        f"downloaded by a retry: {summary['Recovered']} of {summary['Retried']}"
+    )
@@ -0,0 +1,154 @@
+import argparse
+import math
+import os
+from collections import deque
+from pathlib import Path
+from colorama import Fore
+from dir_scan import list_article_dirs
+from download_journal import JOURNAL_FILENAME, DownloadJournal
+from download_pool import (
+    add_download_arguments,
+    BatchQueue,
+    make_batches,
+    make_download_args,
+    prepare_metadata,
+    print_summary,
+    run_download_workers,
+)
+
+################################## argument parsing ###########################################
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--download-dir",
+    type=str,
+    default="/home/salkhon/Documents/thesis/data/images",
+    help="Path to directory where the images will be downloaded, one subdirectory per language",
+)
+parser.add_argument(
+    "--metadata-dir",
+    type=str,
+    default="/home/salkhon/Documents/thesis/data/metadata",
+    help="Directory of the `<lang>.metadata` files, every language in it is downloaded",
+)
+parser.add_argument(
+    "--languages",
+    type=str,
+    default=None,
+    help="Comma separated languages to download, all metadata files of `--metadata-dir` if not given",
+)
+add_download_arguments(parser)
+parser.add_argument(
+    "--max-lang-share",
+    type=float,
+    default=0.5,
+    help="Largest fraction of the batches in flight a single language gets while other languages have work left",
+)
+############################################################################################
+
+
+class LanguageScheduler(BatchQueue):
+    """Schedules the batches of several languages onto one pool of workers.
+
+    The language with the most articles left to hand out goes first, but no language gets more than `max_share` of
+    the batches in flight while another language has work left, so small languages fill the remaining slots while
+    the large ones are still running instead of queueing behind them. While every language with work left is at its
+    share no batch is handed out, the slot waits for a batch to complete. Once a single language is left it gets
+    every slot.
+    """
+
+    def __init__(self, lang_batches: dict[str, list[dict]], num_slots: int, max_share: float):
+        self.pending = {lang: deque(batches) for lang, batches in lang_batches.items()}
+        self.remaining = {
+            lang: sum(batch["end_idx"] - batch["start_idx"] for batch in batches)
+            for lang, batches in lang_batches.items()
+        }
+        self.in_flight = {lang: 0 for lang in lang_batches}
+        self.max_in_flight = max(1, math.floor(num_slots * max_share))
+
+    def has_pending(self) -> bool:
+        return any(len(batches) > 0 for batches in self.pending.values())
+
+    def next_batch(self) -> dict | None:
+        langs = [lang for lang, batches in self.pending.items() if len(batches) > 0]
+        if len(langs) > 1:
+            langs = [lang for lang in langs if self.in_flight[lang] < self.max_in_flight]
+        if len(langs) == 0:
+            return None
+
+        lang = max(langs, key=lambda lang: self.remaining[lang])
+        batch = self.pending[lang].popleft()
+        self.remaining[lang] -= batch["end_idx"] - batch["start_idx"]
+        self.in_flight[lang] += 1
+        return batch
+
+    def complete(self, batch: dict):
+        self.in_flight[batch["metadata"].stem] -= 1
+
+
+def get_metadata_files(metadata_dir: Path, languages: list[str] | None) -> list[Path]:
+    if languages is None:
+        return sorted(metadata_dir.glob("*.metadata"))
+
+    metadata_files = [metadata_dir / f"{lang}.metadata" for lang in languages]
+    for metadata_file in metadata_files:
+        if not metadata_file.exists():
+            raise FileNotFoundError(f"No metadata file {metadata_file}")
+    return metadata_files
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    download_dir = Path(args.download_dir)
+    num_workers = args.maxproc or os.cpu_count()
+    num_slots = num_workers * args.batches_per_worker
+
+    metadata_files = get_metadata_files(
+        Path(args.metadata_dir),
+        args.languages.split(",") if args.languages else None,
+    )
+
+    lang_batches = {}
+    for metadata_file in metadata_files:
+        lang = metadata_file.stem
+        total_articles, plan_summary = prepare_metadata(metadata_file)
+        (download_dir / lang).mkdir(parents=True, exist_ok=True)
+        lang_batches[lang] = make_batches(
+            metadata_file, download_dir / lang, total_articles, args.slice_len
+        )
+        print(
+            f"{lang}: {total_articles} articles, {len(lang_batches[lang])} batches, "
+            f"{plan_summary['Fetch']} images to fetch"
+        )
+
+    scheduler = LanguageScheduler(lang_batches, num_slots, args.max_lang_share)
+    total_articles = sum(scheduler.remaining.values())
+    print(
+        f"Downloading {total_articles} articles of {len(lang_batches)} languages "
+        f"with {num_workers} worker processes, at most {scheduler.max_in_flight} of {num_slots} batches per language"
+    )
+
+    summary = run_download_workers(
+        scheduler,
+        total_articles,
+        make_download_args(args, num_workers),
+        num_workers,
+        args.batches_per_worker,
+    )
+
+    print_summary(summary)
+    for lang in lang_batches:
+        # after the retries, the journal has the final outcome of every image
+        journal = DownloadJournal(download_dir / lang / JOURNAL_FILENAME)
+        num_failed_articles = journal.count_failed_articles()
+        journal.close()
+        if num_failed_articles > 0:
+            print(Fore.RED, f"{lang}: {num_failed_articles} articles with exceptions", Fore.RESET)
+
+        # listed once the journal is closed, its WAL files leaving the directory change its mtime, which would leave
+        # the cached listing stale for postprocessing
+        num_article_dirs = len(list_article_dirs(download_dir / lang))
+        print(
+            Fore.GREEN,
+            f"DOWNLOAD COMPLETE FOR {lang} ({num_article_dirs} article directories)",
+            Fore.RESET,
+        )
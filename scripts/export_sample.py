@@ -0,0 +1,310 @@
+import argparse
+import errno
+import fcntl
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from stats_dataset import read_stats_dataset
+
+# `FICLONE` ioctl, clones a file's extents on filesystems that support it (Btrfs, XFS)
+FICLONE = 0x40049409
+# ways to export an image file, tried in this order
+LINK_MODES = ("hardlink", "reflink", "copy")
+# errors of a link mode the source and destination do not support, the next mode is tried
+UNSUPPORTED_ERRNOS = (
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+)
+
+################################## argument parsing ###########################################
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--stats-dir",
+    type=str,
+    default="/home/salkhon/Documents/thesis/data/images/stats",
+    help="Stats dataset written by `postprocess.py`",
+)
+parser.add_argument(
+    "--imgdir",
+    type=str,
+    default=None,
+    help="Directory of the language image directories, defaults to the parent of `--stats-dir`",
+)
+parser.add_argument(
+    "--dest", type=str, required=True, help="Directory to export the splits to"
+)
+parser.add_argument(
+    "--languages",
+    type=str,
+    default=None,
+    help="Comma separated languages to sample from, all languages of the stats if not given",
+)
+parser.add_argument(
+    "--splits",
+    type=str,
+    default="train=10000,dev=2000,test=2000",
+    help="Comma separated `<split>=<size>` per language, sizes below 1 are fractions of the selected images",
+)
+parser.add_argument(
+    "--all-images",
+    action="store_true",
+    help="Select every useful image, instead of the first image of articles whose first image is useful",
+)
+parser.add_argument(
+    "--keep-duplicate-urls",
+    action="store_true",
+    help="Keep images whose URL was already selected, instead of one image per URL",
+)
+parser.add_argument("--seed", type=int, default=42, help="Random seed of the sampling")
+parser.add_argument(
+    "--link-mode",
+    type=str,
+    choices=("auto", *LINK_MODES),
+    default="auto",
+    help="How image files are exported, `auto` hardlinks, else reflinks, else copies",
+)
+parser.add_argument(
+    "--workers", type=int, default=16, help="Threads exporting the image files"
+)
+############################################################################################
+
+
+def parse_splits(splits: str) -> dict[str, float]:
+    sizes = {}
+    for split in splits.split(","):
+        name, size = split.split("=")
+        sizes[name.strip()] = float(size)
+    return sizes
+
+
+def select_images(
+    stats_dir: Path,
+    languages: list[str] | None,
+    all_images: bool = False,
+    keep_duplicate_urls: bool = False,
+    seed: int = 42,
+) -> pd.DataFrame:
+    """Candidate images of the sample, in random order. Only the matching rows are read: the language and status
+    filters skip whole partitions of the stats dataset.
+
+    Args:
+        stats_dir (Path): Stats dataset
+        languages (list[str] | None): Languages to select from, None for all
+        all_images (bool, optional): Every useful image, instead of the first image of articles whose first image
+            is useful. Defaults to False.
+        keep_duplicate_urls (bool, optional): Keep images whose URL appears earlier in the random order. Defaults to
+            False.
+        seed (int, optional): Random seed of the order. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Useful images, shuffled
+    """
+    filter = ds.field("ImageStatus") == "USEFUL"
+    if not all_images:
+        filter = filter & (ds.field("ArticleIdx") == 0)
+    if languages is not None:
+        filter = filter & ds.field("ArticleLang").isin(languages)
+
+    df = read_stats_dataset(stats_dir, filter=filter)
+    df["ArticleLang"] = df["ArticleLang"].astype(str)
+    df["ImageStatus"] = df["ImageStatus"].astype(str)
+    # the stats dataset has no row order, sort before shuffling so the sample only depends on the seed
+    df = df.sort_values("ImageId", ignore_index=True)
+    df = df.sample(frac=1, random_state=seed)
+    if not keep_duplicate_urls:
+        df = df.drop_duplicates(subset="ImageUrl", keep="first")
+    return df
+
+
+def assign_splits(df: pd.DataFrame, sizes: dict[str, float]) -> pd.DataFrame:
+    """Split the shuffled images of every language: the first `size` images of a language go to the first split,
+    the next ones to the second, and so on.
+
+    Args:
+        df (pd.DataFrame): Shuffled images
+        sizes (dict[str, float]): Split name to its number of images per language, or fraction if below 1
+
+    Returns:
+        pd.DataFrame: Selected images, with their `Split`
+    """
+    position = df.groupby("ArticleLang").cumcount().to_numpy()
+    num_images = df.groupby("ArticleLang")["ImageId"].transform("size").to_numpy()
+
+    split = np.full(len(df), None, dtype=object)
+    start = np.zeros(len(df), dtype=np.int64)
+    for name, size in sizes.items():
+        count = np.floor(num_images * size).astype(np.int64) if size < 1 else np.int64(size)
+        end = start + count
+        split[(position >= start) & (position < end)] = name
+        start = end
+
+    short = df.assign(Wanted=start, Available=num_images)[start > num_images]
+    for lang, row in short.groupby("ArticleLang").first().iterrows():
+        print(f"{lang}: only {row['Available']} of {row['Wanted']} images available")
+
+    return df.assign(Split=split)[split != None]  # noqa: E711
+
+
+class FileExporter:
+    """Export image files into the sample directory, as hardlinks, reflinks or copies.
+
+    In `auto` mode a hardlink is tried first, and a reflink (a copy on write clone of the file's extents) when the
+    sample is on another filesystem, before falling back to a copy. A mode that fails with an error meaning the
+    filesystems do not support it is not tried again. Hardlinked files share their content with the dataset, so they
+    must not be modified in place. An exporter can be shared by threads.
+    """
+
+    def __init__(self, link_mode: str = "auto"):
+        self.modes = list(LINK_MODES if link_mode == "auto" else [link_mode])
+        # guards the demotion of unsupported modes, several threads can fail with the same mode at once
+        self.lock = threading.Lock()
+
+    def link(self, src: Path, dst: Path, mode: str):
+        if mode == "hardlink":
+            os.link(src, dst)
+        elif mode == "reflink":
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                try:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                except OSError:
+                    dst.unlink()
+                    raise
+        else:
+            shutil.copyfile(src, dst)
+
+    def export(self, src: Path, dst: Path) -> str | None:
+        """Export one file, an existing `dst` is kept.
+
+        Returns:
+            str | None: Mode the file was exported with, None if `dst` already existed
+        """
+        if dst.exists():
+            return None
+
+        for mode in list(self.modes):
+            try:
+                self.link(src, dst, mode)
+                return mode
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                with self.lock:
+                    # the last mode is never removed, a mode another thread already removed is skipped
+                    if mode == self.modes[-1]:
+                        raise
+                    if mode in self.modes:
+                        self.modes.remove(mode)
+        raise RuntimeError(f"No link mode left to export {src}")
+
+
+def export_files(
+    srcs: list[Path], dsts: list[Path], link_mode: str, workers: int
+) -> tuple[dict[str, int], list[int]]:
+    """Export the image files with a pool of threads.
+
+    Args:
+        srcs (list[Path]): Image files
+        dsts (list[Path]): Where to export each of them
+        link_mode (str): `auto`, `hardlink`, `reflink` or `copy`
+        workers (int): Number of threads
+
+    Returns:
+        tuple[dict[str, int], list[int]]: Number of files exported with each mode (`existing` for files already
+            there), and the positions of the files that could not be exported
+    """
+    # create the directories once up front, instead of once per file
+    for parent in {dst.parent for dst in dsts}:
+        parent.mkdir(parents=True, exist_ok=True)
+
+    exporter = FileExporter(link_mode)
+
+    def export(i: int) -> str | None:
+        try:
+            return exporter.export(srcs[i], dsts[i]) or "existing"
+        except OSError as e:
+            print(f"Could not export {srcs[i]}: {e}")
+            return None
+
+    counts: dict[str, int] = {}
+    failed = []
+    with ThreadPoolExecutor(workers) as executor:
+        for i, mode in enumerate(executor.map(export, range(len(srcs)), chunksize=256)):
+            if mode is None:
+                failed.append(i)
+            else:
+                counts[mode] = counts.get(mode, 0) + 1
+    return counts, failed
+
+
+def export_sample(
+    sample: pd.DataFrame, img_dir: Path, dest: Path, link_mode: str, workers: int
+) -> pd.DataFrame:
+    """Export the images of the sample to `<dest>/<split>/<lang>/<article>/<name>`, and write a manifest of every
+    split, `<dest>/<split>.csv`, with the stats rows of its images and their `ImagePath` relative to `dest`.
+
+    Args:
+        sample (pd.DataFrame): Selected images, with their `Split`
+        img_dir (Path): Directory of the language image directories
+        dest (Path): Directory to export to
+        link_mode (str): `auto`, `hardlink`, `reflink` or `copy`
+        workers (int): Number of threads exporting the files
+
+    Returns:
+        pd.DataFrame: Exported images, as written to the manifests
+    """
+    sample = sample.sort_index()
+    src_paths = str(img_dir) + "/" + sample["ArticleLang"] + "/" + sample["ImagePath"]
+    dst_paths = (
+        sample["Split"]
+        + "/"
+        + sample["ArticleLang"]
+        + "/"
+        + sample["ImagePath"].str.replace("/USEFUL/", "/", n=1, regex=False)
+    )
+
+    counts, failed = export_files(
+        [Path(path) for path in src_paths],
+        [dest / path for path in dst_paths],
+        link_mode,
+        workers,
+    )
+    print(", ".join(f"{mode}: {count}" for mode, count in counts.items()))
+
+    exported = sample.assign(ImagePath=dst_paths)
+    if len(failed) > 0:
+        print(f"{len(failed)} images could not be exported and are left out of the manifests")
+        exported = exported.drop(exported.index[failed])
+
+    for split, rows in exported.groupby("Split", sort=False):
+        rows.drop(columns="Split").to_csv(dest / f"{split}.csv", index=False)
+        print(f"{split}: {len(rows)} images")
+    return exported
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    stats_dir = Path(args.stats_dir)
+    img_dir = Path(args.imgdir) if args.imgdir else stats_dir.parent
+    dest = Path(args.dest)
+
+    candidates = select_images(
+        stats_dir,
+        args.languages.split(",") if args.languages else None,
+        args.all_images,
+        args.keep_duplicate_urls,
+        args.seed,
+    )
+    sample = assign_splits(candidates, parse_splits(args.splits))
+    print(f"Selected {len(sample)} of {len(candidates)} candidate images")
+
+    dest.mkdir(parents=True, exist_ok=True)
+    export_sample(sample, img_dir, dest, args.link_mode, args.workers)
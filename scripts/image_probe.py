@@ -0,0 +1,94 @@
+import struct
+
+# leading bytes of an image file read to find its format and dimensions
+PROBE_BYTES = 64 * 1024
+
+# JPEG start of frame markers, they carry the image dimensions
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF
+}  # fmt: skip
+
+
+def is_filter_size(width: int, height: int) -> bool:
+    """Filtration criterions, shared by the downloader's early filter and postprocessing.
+
+    Args:
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+
+    Returns:
+        bool: Whether to filter the image
+    """
+    if width <= 0 or height <= 0:
+        return True
+    aspect = width / height
+    return width < 64 or height < 64 or aspect < 0.25 or aspect > 4
+
+
+def probe_jpeg(header: bytes) -> tuple[int, int] | None:
+    pos = 2
+    while pos + 4 <= len(header):
+        if header[pos] != 0xFF:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            # markers without a segment
+            pos += 2
+            continue
+
+        (segment_len,) = struct.unpack(">H", header[pos + 2 : pos + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(header):
+                return None
+            height, width = struct.unpack(">HH", header[pos + 5 : pos + 9])
+            return width, height
+        pos += 2 + segment_len
+    return None
+
+
+def probe_webp(header: bytes) -> tuple[int, int] | None:
+    chunk = header[12:16]
+    if chunk == b"VP8 " and len(header) >= 30:
+        width, height = struct.unpack("<HH", header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(header) >= 25:
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(header) >= 30:
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def probe_image_header(header: bytes) -> tuple[str, int, int] | None:
+    """Read the format and dimensions of an image from the first bytes of its file, without decoding it. Format
+    names match Pillow's `Image.format`.
+
+    Args:
+        header (bytes): Leading bytes of the image file
+
+    Returns:
+        tuple[str, int, int] | None: (format, width, height), None if the format is not recognized or the header
+            is too short to hold the dimensions
+    """
+    size = None
+    if header.startswith(b"\xff\xd8"):
+        fmt, size = "JPEG", probe_jpeg(header)
+    elif header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        fmt, size = "PNG", struct.unpack(">II", header[16:24])
+    elif header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        fmt, size = "GIF", struct.unpack("<HH", header[6:10])
+    elif header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        fmt, size = "WEBP", probe_webp(header)
+    elif header.startswith(b"BM") and len(header) >= 26:
+        width, height = struct.unpack("<ii", header[18:26])
+        fmt, size = "BMP", (width, abs(height))
+
+    if size is None:
+        return None
+    return fmt, size[0], size[1]
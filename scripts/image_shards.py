@@ -0,0 +1,285 @@
+import argparse
+import mmap
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from stats_dataset import read_stats_dataset
+
+# a shard is the magic followed by the bytes of its images back to back, their offsets are in the language's index
+SHARD_MAGIC = b"VLLMSHD1"
+SHARD_TEMPLATE = "shard-{:05d}.bin"
+INDEX_FILENAME = "index.parquet"
+SHARD_SIZE = 1 << 30
+# files read ahead of the writer per reading thread
+READ_AHEAD = 4
+
+################################## argument parsing ###########################################
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--stats-dir",
+    type=str,
+    default="/home/salkhon/Documents/thesis/data/images/stats",
+    help="Stats dataset written by `postprocess.py`",
+)
+parser.add_argument(
+    "--imgdir",
+    type=str,
+    default=None,
+    help="Directory of the language image directories, defaults to the parent of `--stats-dir`",
+)
+parser.add_argument(
+    "--dest",
+    type=str,
+    required=True,
+    help="Directory to write the shards to, one subdirectory per language",
+)
+parser.add_argument(
+    "--languages",
+    type=str,
+    default=None,
+    help="Comma separated languages to pack, all languages of the stats if not given",
+)
+parser.add_argument(
+    "--shard-size",
+    type=int,
+    default=SHARD_SIZE,
+    help="Start a new shard once the current one holds this many bytes",
+)
+parser.add_argument(
+    "--workers", type=int, default=16, help="Threads reading the image files ahead of the writer"
+)
+############################################################################################
+
+
+def get_shard_dir(dest: Path, lang: str) -> Path:
+    return dest / lang
+
+
+def replace_dir(src: Path, dst: Path):
+    """Move the directory `src` to `dst`, replacing the directory at `dst` if any. The old directory is moved aside
+    before `src` is renamed into place, so `dst` never mixes the files of both.
+    """
+    old = dst.with_name(f".{dst.name}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    if dst.exists():
+        dst.replace(old)
+    src.replace(dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def read_image(path: Path) -> bytes | None:
+    try:
+        return path.read_bytes()
+    except OSError as e:
+        print(f"Could not read {path}: {e}")
+        return None
+
+
+def pack_language(
+    stats: pd.DataFrame, img_dir: Path, shard_dir: Path, shard_size: int, workers: int
+) -> pd.DataFrame:
+    """Pack the useful images of one language into shards, and write their index.
+
+    Images are packed in the order of their `ImagePath`, so the images of an article are next to each other and the
+    source directories are read front to back. A pool of threads reads a bounded window of files ahead of the writer.
+    Shards and the index are written to a hidden `.<lang>.partial` directory, which replaces `shard_dir` once
+    complete, so re-packing a language never leaves an index pointing into rewritten shards, nor shards of an
+    earlier pack behind.
+
+    Args:
+        stats (pd.DataFrame): Stats rows of the useful images of the language
+        img_dir (Path): Directory of the language's article directories
+        shard_dir (Path): Directory to write the shards and the index to
+        shard_size (int): Start a new shard once the current one holds this many bytes
+        workers (int): Number of threads reading the image files
+
+    Returns:
+        pd.DataFrame: Index, the stats rows of the packed images with their `Shard`, `Offset` and `Length`
+    """
+    partial_dir = shard_dir.with_name(f".{shard_dir.name}.partial")
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    partial_dir.mkdir(parents=True)
+    stats = stats.sort_values("ImagePath", ignore_index=True)
+    paths = [img_dir / path for path in stats["ImagePath"]]
+
+    packed = []
+    shards, offsets, lengths = [], [], []
+    shard_idx = 0
+    shard_file = None
+    shard_path = None
+
+    with ThreadPoolExecutor(workers) as executor:
+        # read ahead of the writer, but keep at most `READ_AHEAD` files per thread in memory
+        reads = deque()
+        next_idx = 0
+        while len(reads) > 0 or next_idx < len(paths):
+            while next_idx < len(paths) and len(reads) < workers * READ_AHEAD:
+                reads.append((next_idx, executor.submit(read_image, paths[next_idx])))
+                next_idx += 1
+
+            i, read = reads.popleft()
+            data = read.result()
+            if data is None:
+                continue
+
+            if shard_file is not None and shard_file.tell() + len(data) > shard_size:
+                shard_file.close()
+                shard_idx += 1
+                shard_file = None
+            if shard_file is None:
+                shard_path = partial_dir / SHARD_TEMPLATE.format(shard_idx)
+                shard_file = open(shard_path, "wb")
+                shard_file.write(SHARD_MAGIC)
+
+            packed.append(i)
+            shards.append(shard_path.name)
+            offsets.append(shard_file.tell())
+            lengths.append(len(data))
+            shard_file.write(data)
+
+    if shard_file is not None:
+        shard_file.close()
+
+    index = stats.iloc[packed].reset_index(drop=True)
+    index["Shard"] = shards
+    index["Offset"] = offsets
+    index["Length"] = lengths
+    pq.write_table(
+        pa.Table.from_pandas(index, preserve_index=False), partial_dir / INDEX_FILENAME
+    )
+    replace_dir(partial_dir, shard_dir)
+
+    if len(packed) < len(stats):
+        print(f"{len(stats) - len(packed)} images could not be read and were not packed")
+    return index
+
+
+class ShardReader:
+    """Random and sequential access to packed images.
+
+    Shards are memory mapped on first use, and images are handed out as `memoryview`s into the mapping, so no bytes
+    are copied until the caller decodes them, e.g. `Image.open(io.BytesIO(view))`. The views are only valid until
+    the reader is closed; `close` fails with `BufferError` while a view is still referenced.
+
+    Example:
+        with ShardReader(Path("data/shards")) as reader:
+            view = reader.get("<ImageId>")
+            for image_id, view in reader.iter_images("bn"):
+                ...
+    """
+
+    def __init__(self, root: Path, languages: list[str] | None = None):
+        self.root = root
+        index_paths = (
+            # hidden directories are packs in progress or being replaced
+            sorted(path for path in root.glob(f"*/{INDEX_FILENAME}") if not path.parent.name.startswith("."))
+            if languages is None
+            else [get_shard_dir(root, lang) / INDEX_FILENAME for lang in languages]
+        )
+        indices = [pq.read_table(path).to_pandas() for path in index_paths]
+        self.index = (
+            pd.concat(indices, ignore_index=True) if len(indices) > 0 else pd.DataFrame()
+        )
+        # an article, and so its images, can be in several languages, ImageId is only unique within a language
+        self.locations = {
+            (lang, image_id): (lang, shard, offset, length)
+            for image_id, lang, shard, offset, length in zip(
+                self.index.get("ImageId", []),
+                self.index.get("ArticleLang", []),
+                self.index.get("Shard", []),
+                self.index.get("Offset", []),
+                self.index.get("Length", []),
+            )
+        }
+        self.languages = [path.parent.name for path in index_paths]
+        self.mmaps: dict[Path, mmap.mmap] = {}
+
+    def get_mmap(self, path: Path) -> mmap.mmap:
+        if path not in self.mmaps:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if mm[: len(SHARD_MAGIC)] != SHARD_MAGIC:
+                mm.close()
+                raise ValueError(f"{path} is not an image shard")
+            self.mmaps[path] = mm
+        return self.mmaps[path]
+
+    def view(self, lang: str, shard: str, offset: int, length: int) -> memoryview:
+        mm = self.get_mmap(get_shard_dir(self.root, lang) / shard)
+        return memoryview(mm)[offset : offset + length]
+
+    def get(self, image_id: str, lang: str | None = None) -> memoryview:
+        """Bytes of an image, without copying them out of the shard.
+
+        Args:
+            image_id (str): `ImageId` of the image
+            lang (str | None, optional): Language of the image, only optional if the reader has a single language.
+                Defaults to None.
+
+        Raises:
+            ValueError: No language given, and the reader has several languages
+            KeyError: No packed image of the language has this `ImageId`
+        """
+        if lang is None:
+            if len(self.languages) != 1:
+                raise ValueError("Pass the language of the image, the reader has several languages")
+            lang = self.languages[0]
+        return self.view(*self.locations[(lang, image_id)])
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def iter_images(self, lang: str) -> Iterator[tuple[str, memoryview]]:
+        """Images of a language in the order they are stored, reading every shard front to back."""
+        rows = self.index[self.index["ArticleLang"] == lang]
+        shard_dir = get_shard_dir(self.root, lang)
+        for shard, shard_rows in rows.groupby("Shard", sort=True):
+            self.get_mmap(shard_dir / shard).madvise(mmap.MADV_SEQUENTIAL)
+            for image_id, offset, length in zip(
+                shard_rows["ImageId"], shard_rows["Offset"], shard_rows["Length"]
+            ):
+                yield image_id, self.view(lang, shard, offset, length)
+
+    def close(self):
+        for mm in self.mmaps.values():
+            mm.close()
+        self.mmaps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    stats_dir = Path(args.stats_dir)
+    img_dir = Path(args.imgdir) if args.imgdir else stats_dir.parent
+    dest = Path(args.dest)
+
+    filter = ds.field("ImageStatus") == "USEFUL"
+    if args.languages:
+        filter = filter & ds.field("ArticleLang").isin(args.languages.split(","))
+    stats = read_stats_dataset(stats_dir, filter=filter)
+    stats["ArticleLang"] = stats["ArticleLang"].astype(str)
+    stats["ImageStatus"] = stats["ImageStatus"].astype(str)
+
+    for lang, lang_stats in stats.groupby("ArticleLang"):
+        index = pack_language(
+            lang_stats,
+            img_dir / lang,
+            get_shard_dir(dest, lang),
+            args.shard_size,
+            args.workers,
+        )
+        print(
+            f"{lang}: {len(index)} images, {index['Length'].sum()} bytes "
+            f"in {index['Shard'].nunique()} shards"
+        )
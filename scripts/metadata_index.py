@@ -0,0 +1,174 @@
+import json
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Iterator
+
+# sidecar index layout: header, then one little endian uint64 byte offset per article line, followed by the
+# metadata file size as a sentinel so that line `i` spans `[offsets[i], offsets[i + 1])`
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"MDIDX001"
+INDEX_HEADER = struct.Struct("<8sQQQ")  # magic, metadata size, metadata mtime_ns, number of lines
+OFFSET = struct.Struct("<Q")
+
+
+def iter_metadata_file(path: Path) -> Iterator[dict]:
+    """Stream the metadata file, where each line contains a JSON. Lines are decoded one at a time, so the whole
+    file is never held in memory.
+
+    Args:
+        path (Path): Path to metadata file. File should contain a JSON in each line.
+
+    Yields:
+        dict: JSON of each line of the metadata file, converted to a dictionary.
+    """
+    with path.open() as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_index_path(path: Path) -> Path:
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def is_index_fresh(path: Path) -> bool:
+    """Whether the sidecar index exists and was built from the current version of the metadata file.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        bool: Whether the index can be used as is
+    """
+    index_path = get_index_path(path)
+    if not index_path.exists():
+        return False
+
+    mdata_stat = path.stat()
+    with index_path.open("rb") as f:
+        header = f.read(INDEX_HEADER.size)
+    if len(header) != INDEX_HEADER.size:
+        return False
+
+    magic, size, mtime_ns, _ = INDEX_HEADER.unpack(header)
+    return (
+        magic == INDEX_MAGIC
+        and size == mdata_stat.st_size
+        and mtime_ns == mdata_stat.st_mtime_ns
+    )
+
+
+def build_line_index(path: Path) -> Path:
+    """Scan the metadata file once and store the byte offset of every article line in a sidecar file next to it
+    (`<name>.metadata.idx`). The index is written to a temporary file first and renamed in place, so concurrent
+    builders never leave a half written index behind.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        Path: Path to the sidecar index
+    """
+    mdata_stat = path.stat()
+    offsets = array("Q")
+
+    with path.open("rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets.append(offset)
+            offset += len(line)
+    offsets.append(mdata_stat.st_size)
+
+    if offsets.itemsize != OFFSET.size:
+        raise RuntimeError("uint64 array is not 8 bytes on this platform")
+    if sys.byteorder != "little":
+        offsets.byteswap()
+
+    index_path = get_index_path(path)
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(
+            INDEX_HEADER.pack(
+                INDEX_MAGIC,
+                mdata_stat.st_size,
+                mdata_stat.st_mtime_ns,
+                len(offsets) - 1,
+            )
+        )
+        offsets.tofile(f)
+    os.replace(tmp_path, index_path)
+
+    return index_path
+
+
+def ensure_line_index(path: Path) -> Path:
+    """Build the sidecar index unless an up to date one already exists.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        Path: Path to the sidecar index
+    """
+    if is_index_fresh(path):
+        return get_index_path(path)
+    return build_line_index(path)
+
+
+def count_articles(path: Path) -> int:
+    """Number of articles in the metadata file, read from the header of the sidecar index.
+
+    Args:
+        path (Path): Path to metadata file
+
+    Returns:
+        int: Number of articles
+    """
+    with ensure_line_index(path).open("rb") as f:
+        _, _, _, nlines = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    return nlines
+
+
+def read_metadata_slice(
+    path: Path, start: int | None, end: int | None, step: int | None = 1
+) -> list[dict]:
+    """Read `metadata[start:end:step]` of the metadata file. The sidecar index is used to seek straight to the
+    first article of the slice, so only the lines of the slice are read and decoded.
+
+    Args:
+        path (Path): Path to metadata file
+        start (int | None): Starting index of article list slice
+        end (int | None): Ending index of article list slice
+        step (int | None, optional): Step size of article list slice. Defaults to 1.
+
+    Returns:
+        list[dict]: Articles of the slice, converted to dictionaries
+    """
+    index_path = ensure_line_index(path)
+
+    with index_path.open("rb") as f:
+        _, _, _, nlines = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        indices = range(nlines)[slice(start, end, step)]
+        if len(indices) == 0:
+            return []
+
+        lo, hi = min(indices), max(indices) + 1
+        f.seek(INDEX_HEADER.size + lo * OFFSET.size)
+        offsets = array("Q")
+        offsets.fromfile(f, hi - lo + 1)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+
+    with path.open("rb") as f:
+        f.seek(offsets[0])
+        block = f.read(offsets[-1] - offsets[0])
+
+    base = offsets[0]
+    return [
+        json.loads(block[offsets[i - lo] - base : offsets[i - lo + 1] - base])
+        for i in indices
+    ]
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import io
+import random
+import re
+from aiohttp import web
+from PIL import Image
+
+# synthetic image URLs: /img/<name>_<width>x<height>.<ext>, e.g. /img/a12_3_640x480.jpg
+IMAGE_PATH_PATTERN = re.compile(r"_(\d+)x(\d+)\.(\w+)$")
+FORMATS = {"jpg": "JPEG", "png": "PNG", "gif": "GIF", "webp": "WEBP", "bmp": "BMP"}
+CONTENT_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+    "WEBP": "image/webp",
+    "BMP": "image/bmp",
+}
+
+
+class MockImageServer:
+    """Local stand-in for the BBC media hosts, serving synthetic images of the size and format encoded in the URL.
+
+    Every request waits `latency` seconds (plus up to `jitter`), then fails with a 500 with probability
+    `error_rate`, or is throttled with a 429 and `Retry-After: <retry_after>` with probability `throttle_rate`.
+    URLs whose name starts with `missing` always answer 404. Images are generated once per size and format.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 1,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.images: dict[tuple[str, int, int], bytes] = {}
+        self.counts = {"requests": 0, "images": 0, "bytes": 0, "errors": 0, "throttled": 0}
+
+    def get_image(self, img_format: str, width: int, height: int) -> bytes:
+        key = (img_format, width, height)
+        if key not in self.images:
+            img = Image.new("RGB", (width, height), (self.random.randrange(256), 64, 128))
+            buffer = io.BytesIO()
+            img.save(buffer, img_format)
+            self.images[key] = buffer.getvalue()
+        return self.images[key]
+
+    async def handle_image(self, request: web.Request) -> web.Response:
+        self.counts["requests"] += 1
+        name = request.match_info["name"]
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+
+        match = IMAGE_PATH_PATTERN.search(name)
+        if name.startswith("missing") or match is None or match[3] not in FORMATS:
+            return web.Response(status=404)
+
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.counts["errors"] += 1
+            return web.Response(status=500)
+        if roll < self.error_rate + self.throttle_rate:
+            self.counts["throttled"] += 1
+            return web.Response(
+                status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+
+        img_format = FORMATS[match[3]]
+        body = self.get_image(img_format, int(match[1]), int(match[2]))
+        self.counts["images"] += 1
+        self.counts["bytes"] += len(body)
+        return web.Response(body=body, content_type=CONTENT_TYPES[img_format])
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.counts)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/img/{name}", self.handle_image)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds every request waits"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Up to this many extra seconds of random wait"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500"
+    )
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429"
+    )
+    parser.add_argument(
+        "--retry-after", type=int, default=1, help="`Retry-After` seconds of the 429 responses"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    server = MockImageServer(
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.throttle_rate,
+        args.retry_after,
+        args.seed,
+    )
+    web.run_app(server.make_app(), host="127.0.0.1", port=args.port, print=None)
@@ -1,11 +1,17 @@
-import subprocess
 import argparse
-from multiprocessing import Pool
-from download_asyncio import read_metadata_file
+import os
 from pathlib import Path
-from tqdm.contrib.concurrent import process_map
-from tqdm import tqdm
 from colorama import Fore
+from download_pool import (
+    add_download_arguments,
+    make_batches,
+    make_download_args,
+    prepare_metadata,
+    print_summary,
+    run_download_workers,
+)
+from dir_scan import list_article_dirs
+from download_journal import JOURNAL_FILENAME, DownloadJournal
 
 ################################## argument parsing ###########################################
 parser = argparse.ArgumentParser()
@@ -21,24 +27,7 @@ parser.add_argument(
     default="/home/salkhon/Documents/thesis/data/metadata/chinese_simplified.metadata",
     help="Path to metadata file of the article",
 )
-parser.add_argument(
-    "--max-retry",
-    type=int,
-    default=3,
-    help="Maximum retry count if file download fails",
-)
-parser.add_argument(
-    "--slice-len",
-    type=int,
-    default=500,
-    help="Number of files downloaded by a single async process",
-)
-parser.add_argument(
-    "--timeout", type=int, default=500, help="Timeout for download request, in seconds"
-)
-parser.add_argument(
-    "--maxproc", type=int, default=None, help="Maximum number of concurrent processes"
-)
+add_download_arguments(parser)
 
 
 args = parser.parse_args()
@@ -48,56 +37,21 @@ METADATA_FILEPATH = Path(args.metadata_path)
 MAX_RETRY = args.max_retry
 SLICE_LEN = args.slice_len
 TIMEOUT = args.timeout
-MAXPROC = args.maxproc
+MAX_CONCURRENCY = args.max_concurrency
+HOST_RATE = args.host_rate
+MIN_HOST_RATE = args.min_host_rate
+MAX_HOST_RATE = args.max_host_rate
+MAXPROC = args.maxproc or os.cpu_count()
+BATCHES_PER_WORKER = args.batches_per_worker
 ############################################################################################
 
 
-def execute_async_download_script(arg_dict):
-    subprocess.call(
-        f"""
-        python3 scripts/download_asyncio.py \
-        --download-dir "{arg_dict['download_dir']}" \
-        --metadata "{arg_dict['metadata']}" \
-        --start-idx {arg_dict['start_idx']} \
-        --end-idx {arg_dict['end_idx']} \
-        --step 1 \
-        --max-retry {arg_dict['max_retry']} \
-        --timeout {arg_dict['timeout']} \
-        """,
-        shell=True,
-        stdout=subprocess.DEVNULL,
-    )
-    return (arg_dict["start_idx"], arg_dict["end_idx"])
-
-
-def count_exceptions(img_dir: Path) -> int:
-    count = 0
-    for item in img_dir.rglob("exceptions_metadata.json"):
-        if item.is_file():
-            count += 1
-    return count
-
-
 if __name__ == "__main__":
     lang = METADATA_FILEPATH.stem
     lang_img_subdir = DOWNLOAD_DIR / lang
 
-    mdata_dict = read_metadata_file(METADATA_FILEPATH)
-    total_articles = len(mdata_dict)
-
-    async_script_args = [
-        {
-            "download_dir": lang_img_subdir,
-            "metadata": METADATA_FILEPATH,
-            "start_idx": start_idx,
-            "end_idx": min(start_idx + SLICE_LEN, total_articles),
-            "max_retry": MAX_RETRY,
-            "timeout": TIMEOUT,
-        }
-        for start_idx in range(0, total_articles, SLICE_LEN)
-    ]
-
-    num_subproc = len(async_script_args)
+    total_articles, plan_summary = prepare_metadata(METADATA_FILEPATH)
+    batches = make_batches(METADATA_FILEPATH, lang_img_subdir, total_articles, SLICE_LEN)
 
     print(
         f"""
@@ -106,33 +60,42 @@ if __name__ == "__main__":
         Metadata File: {METADATA_FILEPATH}, 
         Language: {lang}, 
         Total Number of Articles: {total_articles}, 
-        Slice Length: {SLICE_LEN}, 
+        Images to Fetch: {plan_summary['Fetch']} ({plan_summary['Unique URLs']} unique URLs, {len(plan_summary['Hosts'])} hosts), 
+        Skipped Links: {plan_summary['Skipped']}, 
+        Batch Length: {SLICE_LEN}, 
         Timeout: {TIMEOUT}, 
         Max Retry: {MAX_RETRY}, 
-        Number of Total Subprocesses: {num_subproc}
+        Max Concurrency: {MAX_CONCURRENCY}, 
+        Host Rate: {HOST_RATE} requests/s ({MIN_HOST_RATE} to {MAX_HOST_RATE}), 
+        Number of Batches: {len(batches)}, 
+        Number of Worker Processes: {MAXPROC}
     """
     )
     _ = input(Fore.YELLOW + "Press ENTER to proceed... (Ctrl+C to cancel)" + Fore.RESET)
 
-    lang_img_subdir.mkdir(exist_ok=True)
+    lang_img_subdir.mkdir(parents=True, exist_ok=True)
+
+    summary = run_download_workers(
+        batches,
+        total_articles,
+        make_download_args(args, MAXPROC),
+        MAXPROC,
+        BATCHES_PER_WORKER,
+    )
 
-    with Pool(MAXPROC, initializer=tqdm.set_lock, initargs=(tqdm.get_lock(),)) as pool:
-        _ = list(
-            tqdm(
-                pool.imap_unordered(execute_async_download_script, async_script_args),
-                total=num_subproc,
-                desc="TOTAL",
-                position=0,
-                colour="green",
-                dynamic_ncols=True,
-            )
-        )
+    # after the retries, the journal has the final outcome of every image
+    journal = DownloadJournal(lang_img_subdir / JOURNAL_FILENAME)
+    num_failed_articles = journal.count_failed_articles()
+    journal.close()
+    # list the article directories once now, postprocessing reuses the cached listing. Closing the journal removes
+    # its WAL files, which changes the directory's mtime, so the listing comes last
+    num_article_dirs = len(list_article_dirs(lang_img_subdir))
 
-    # Find exception count
-    articles_with_exceptions = count_exceptions(lang_img_subdir)
+    print_summary(summary)
     print(
         Fore.RED,
-        f"Number of articles with exceptions: {articles_with_exceptions}",
+        f"Number of articles with exceptions: {num_failed_articles}",
         Fore.RESET,
     )
+    print(f"Article directories in {lang_img_subdir}: {num_article_dirs}")
     print(Fore.GREEN, f"DOWNLOAD COMPLETE FOR {lang}", Fore.RESET)
@@ -1,12 +1,18 @@
 import os
+import zlib
+from multiprocessing import Pool
 from PIL import Image
 import json
 from pathlib import Path
 import argparse
 from enum import Enum
-import pandas as pd
 from colorama import Fore
 from tqdm import tqdm
+from image_probe import PROBE_BYTES, is_filter_size, probe_image_header
+from dir_scan import list_article_dirs
+from download_journal import JOURNAL_FILENAME, DownloadJournal, JournalStatus
+from stats_buffer import OUTPUT_FORMATS, StatsBuffer
+from stats_dataset import get_lang_partition
 
 ################################## argument parsing ###########################################
 parser = argparse.ArgumentParser()
@@ -16,13 +22,81 @@ parser.add_argument(
     default="/home/salkhon/Documents/thesis/data/images/yoruba",
     help="Directory where the images will be found",
 )
+parser.add_argument(
+    "--maxproc",
+    type=int,
+    default=None,
+    help="Number of worker processes, defaults to the number of CPUs",
+)
+
+parser.add_argument(
+    "--flush-rows",
+    type=int,
+    default=100_000,
+    help="Number of stats rows buffered in memory before they are appended to the output",
+)
+parser.add_argument(
+    "--output-format",
+    type=str,
+    choices=OUTPUT_FORMATS,
+    default="parquet",
+    help="Write the stats as a partition of the Parquet stats dataset, or as `<imgdir>/<lang>.csv`",
+)
+parser.add_argument(
+    "--stats-dir",
+    type=str,
+    default=None,
+    help="Root of the Parquet stats dataset shared by all languages, defaults to `<imgdir>/../stats`",
+)
+parser.add_argument(
+    "--verify-sample",
+    type=float,
+    default=0.0,
+    help="Fraction of the images (sampled by Image Id) that are fully decoded to detect truncated or broken files",
+)
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help="Classify every article and rewrite the stats, instead of only the new or re-downloaded articles",
+)
 
 args = parser.parse_args()
-IMGDIR = Path(args.imgdir)
+IMGDIR = Path(args.imgdir).absolute()
+MAXPROC = args.maxproc
+FLUSH_ROWS = args.flush_rows
+OUTPUT_FORMAT = args.output_format
+STATS_DIR = (
+    Path(args.stats_dir).absolute() if args.stats_dir else IMGDIR.parent / "stats"
+)
+FULL = args.full
+VERIFY_SAMPLE = args.verify_sample
 ############################################################################################
 
 LANG = IMGDIR.name
 
+DF_COLUMNS = (
+    "ImageId",
+    "ImageUrl",
+    "ArticleId",
+    "ArticleLang",
+    "ArticleIdx",
+    "ArticleUrl",
+    "ImageStatus",
+    "ImagePath",
+    "ImageFileSize",
+    "ImageFormat",
+    "ImageWidth",
+    "ImageHeight",
+    "ImageAspectRatio",
+)
+IMG_INFO_COLUMNS = (
+    "ImageFileSize",
+    "ImageFormat",
+    "ImageWidth",
+    "ImageHeight",
+    "ImageAspectRatio",
+)
+
 
 class ImageStatus(Enum):
     USEFUL = "USEFUL"
@@ -33,15 +107,38 @@ class ImageStatus(Enum):
     MISSING = "MISSING"
 
 
+# journal of the image directory, opened once in each worker process
+journal: DownloadJournal | None = None
+
+
+def get_journal() -> DownloadJournal | None:
+    global journal
+    if journal is None and Path(JOURNAL_FILENAME).exists():
+        journal = DownloadJournal(Path(JOURNAL_FILENAME))
+    return journal
+
+
 def read_article_img_mdatas(article_dir: Path) -> tuple:
-    """Read metadata associated with downloaded article.
+    """Read metadata associated with downloaded article, from the journal of the image directory. Articles the
+    journal has no records of (downloaded before the journal kept the metadata) are read from their JSON files.
 
     Args:
         article_dir (Path): Path to article directory
 
     Returns:
-        tuple[list[dict]*3]: Tuple of list of metadata dicts: successful, skipped, exceptions
+        tuple[list[dict]*4]: Tuple of list of metadata dicts: successful, skipped, exceptions, filtered during
+            download
     """
+    article_journal = get_journal()
+    if article_journal is not None:
+        records = article_journal.article_records(article_dir.name)
+        if any(len(mdatas) > 0 for mdatas in records.values()):
+            return (
+                records[JournalStatus.DONE],
+                records[JournalStatus.SKIPPED],
+                records[JournalStatus.FAILED],
+                records[JournalStatus.FILTERED],
+            )
 
     def read_downloaded_mdata(mdata_path: Path) -> list[dict]:
         mdata_dicts = []
@@ -53,26 +150,26 @@ def read_article_img_mdatas(article_dir: Path) -> tuple:
     successful_mdata = read_downloaded_mdata(article_dir / "successful_metadata.json")
     skipped_mdata = read_downloaded_mdata(article_dir / "skipped_links.json")
     exceptions_mdata = read_downloaded_mdata(article_dir / "exceptions_metadata.json")
+    filtered_mdata = read_downloaded_mdata(article_dir / "filtered_metadata.json")
 
     return (
         successful_mdata,
         skipped_mdata,
         exceptions_mdata,
+        filtered_mdata,
     )
 
 
-def remove_json_metadata(article_dir: Path):
-    (article_dir / "successful_metadata.json").unlink(missing_ok=True)
-    (article_dir / "skipped_links.json").unlink(missing_ok=True)
-    (article_dir / "exceptions_metadata.json").unlink(missing_ok=True)
-
-
 def insert_mdata_into_df_dict(
     mdata: dict,
     df_dict: dict[str, list],
+    url_rows: dict[str, int],
     img_status: ImageStatus,
     img_info: dict,
 ):
+    # the first row of each URL, to find previously moved images without scanning the rows
+    url_rows.setdefault(mdata["Image URL"], len(df_dict["ImageUrl"]))
+
     df_dict["ImageId"].append(mdata["Id"])
     df_dict["ImageUrl"].append(mdata["Image URL"])
     df_dict["ArticleId"].append(mdata["Article Id"])
@@ -110,165 +207,427 @@ def move_img_update_mdata_path(
     return new_img_path
 
 
-def get_img_info(img_path: Path, img: Image.Image):
+def scan_article_files(article_dir: Path) -> dict[Path, int]:
+    """List the image files of an article, including those sorted into `USEFUL/`, `FILTERED/` and `CORRUPT/`, with
+    one directory scan each instead of a `stat` per metadata entry.
+
+    Args:
+        article_dir (Path): Path to the article's directory, relative to the image directory
+
+    Returns:
+        dict[Path, int]: Path of each file, relative to the image directory, to its size in bytes
+    """
+    sorted_subdirs = {
+        img_status.value
+        for img_status in (ImageStatus.USEFUL, ImageStatus.FILTERED, ImageStatus.CORRUPT)
+    }
+    files = {}
+    dirs = [article_dir]
+    while len(dirs) > 0:
+        scan_dir = dirs.pop()
+        with os.scandir(scan_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if scan_dir == article_dir and entry.name in sorted_subdirs:
+                        dirs.append(scan_dir / entry.name)
+                elif entry.is_file():
+                    files[scan_dir / entry.name] = entry.stat().st_size
+    return files
+
+
+def find_sorted_img(
+    img_path: Path, files: dict[Path, int]
+) -> tuple[Path, ImageStatus] | None:
+    """Find an image that was already moved to the `USEFUL/`, `FILTERED/` or `CORRUPT/` subdirectory of its article.
+
+    Args:
+        img_path (Path): Path of the image as downloaded
+        files (dict[Path, int]): Files of the article, from `scan_article_files`
+
+    Returns:
+        tuple[Path, ImageStatus] | None: Path it was moved to and its status, None if it was not moved
+    """
+    for img_status in (ImageStatus.USEFUL, ImageStatus.FILTERED, ImageStatus.CORRUPT):
+        sorted_img_path = img_path.parent / img_status.value / img_path.name
+        if sorted_img_path in files:
+            return sorted_img_path, img_status
+    return None
+
+
+def is_verify_sample(img_id: str) -> bool:
+    # the same images are sampled on every run
+    return zlib.crc32(img_id.encode()) < VERIFY_SAMPLE * 2**32
+
+
+def probe_img(img_path: Path, verify: bool = False) -> tuple[str, int, int] | None:
+    """Read the format and dimensions of an image from its header, without decoding it. Formats the header prober
+    does not recognize are opened with Pillow instead.
+
+    Args:
+        img_path (Path): Path to the image
+        verify (bool, optional): Also decode the image with Pillow to detect broken data. Defaults to False.
+
+    Returns:
+        tuple[str, int, int] | None: (format, width, height), None if the image is corrupt
+    """
+    try:
+        with img_path.open("rb") as f:
+            header = f.read(PROBE_BYTES)
+    except OSError:
+        return None
+
+    probed = probe_image_header(header)
+    if probed is not None and not verify:
+        return probed
+
+    try:
+        with Image.open(img_path) as img:
+            probed = img.format, img.width, img.height
+            if verify:
+                # decodes the pixel data, raises on truncated or broken data
+                img.load()
+    except Exception:
+        return None
+    return probed
+
+
+def get_img_info(size: int, img_format: str, width: int, height: int):
     return {
-        "ImageFileSize": img_path.stat().st_size,
-        "ImageFormat": img.format,
-        "ImageWidth": img.width,
-        "ImageHeight": img.height,
-        "ImageAspectRatio": round(img.width / img.height, 4),
+        "ImageFileSize": size,
+        "ImageFormat": img_format,
+        "ImageWidth": width,
+        "ImageHeight": height,
+        "ImageAspectRatio": round(width / height, 4) if height else None,
     }
 
 
-def organize_article_imgs(article_dir: Path, df_dict: dict[str, list]):
+def organize_article_imgs(
+    article_dir: Path, df_dict: dict[str, list], url_rows: dict[str, int]
+):
     """Performs filtration of images for this article. Useful, filtered, corrupt images are moved to their
     corresponding subdirectories named: `useful`, `filtered`, `corrupt`.
     Filtration criterion:
     1. Height or width is < 150px
     2. Aspect ratio > 2 or < 0.5
 
-    Appends metadata of this article to the `df_dict` dictionary.
+    Appends metadata of this article to the `df_dict` dictionary. Format and dimensions are read from the image
+    headers, only images sampled by `--verify-sample` are fully decoded.
 
     Args:
         article_dir (Path): Path to this article's directory
         df_dict: dict[str, list]: Dictionary for the images for this language, accumulated over each article
+        url_rows (dict[str, int]): Index of the first row of each URL in `df_dict`, kept up to date on insertion
     """
 
-    def is_filter(img: Image.Image) -> bool:
-        """Filtration criterions.
-
-        Args:
-            img (Image.Image): Pillow Image
-
-        Returns:
-            bool: Whether to filter the image
-        """
-        w, h = img.size
-        aspect = w / h
-        return w < 64 or h < 64 or aspect < 0.25 or aspect > 4
-
-    success_mdata, skipped_mdata, exceptions_mdata = read_article_img_mdatas(
-        article_dir
-    )
+    (
+        success_mdata,
+        skipped_mdata,
+        exceptions_mdata,
+        filtered_mdata,
+    ) = read_article_img_mdatas(article_dir)
 
     # These images don't exist, so not image related info added, just the metadata
     for skipped_mdata in skipped_mdata:
-        insert_mdata_into_df_dict(skipped_mdata, df_dict, ImageStatus.SKIPPED, {})
+        insert_mdata_into_df_dict(
+            skipped_mdata, df_dict, url_rows, ImageStatus.SKIPPED, {}
+        )
     for exception_mdata in exceptions_mdata:
-        insert_mdata_into_df_dict(exception_mdata, df_dict, ImageStatus.EXCEPTION, {})
+        insert_mdata_into_df_dict(
+            exception_mdata, df_dict, url_rows, ImageStatus.EXCEPTION, {}
+        )
+
+    # filtered by their header during download, never written to disk. "Image Path" is None
+    for filtered_mdata in filtered_mdata:
+        w, h = filtered_mdata["Image Width"], filtered_mdata["Image Height"]
+        insert_mdata_into_df_dict(
+            filtered_mdata,
+            df_dict,
+            url_rows,
+            ImageStatus.FILTERED,
+            {
+                "ImageFormat": filtered_mdata["Image Format"],
+                "ImageWidth": w,
+                "ImageHeight": h,
+                "ImageAspectRatio": round(w / h, 4) if h else None,
+            },
+        )
 
     # iterate over the images in this article's directory, disribute them in `useful/`, `filtered/`, `corrupted/`
+    files = scan_article_files(article_dir)
     for success_mdata in success_mdata:
         img_path = Path(success_mdata["Image Path"])  # relative to download dir
 
-        try:
-            img = Image.open(img_path)
-            if not img:
-                raise Exception("Read image is none")
-        except FileNotFoundError as _:
-            # the metadata file has the same URL multiple times for some articles,
-            # so they have dupicate entries that may have been already moved to`useful/`, `filtered/`, `corrupted/`
-
-            # find if this image was previously moved (URL will match with existing records)
-            try:
-                idx = df_dict["ImageUrl"].index(success_mdata["Image URL"])
-            except ValueError as _:
+        if img_path not in files:
+            sorted_img = find_sorted_img(img_path, files)
+            if sorted_img is not None:
+                # moved by an earlier run, or by a duplicate entry of this article. Keep it where it is
+                sorted_img_path, img_status = sorted_img
+                success_mdata["Image Path"] = str(sorted_img_path)
+                size = files[sorted_img_path]
+                probed = (
+                    None
+                    if img_status == ImageStatus.CORRUPT
+                    else probe_img(sorted_img_path)
+                )
+                img_info = (
+                    {"ImageFileSize": size}
+                    if probed is None
+                    else get_img_info(size, *probed)
+                )
+                insert_mdata_into_df_dict(
+                    success_mdata, df_dict, url_rows, img_status, img_info
+                )
+                continue
+
+            # the metadata has the same URL multiple times for some articles, the image may have been moved by
+            # another article (URL will match with existing records)
+            idx = url_rows.get(success_mdata["Image URL"])
+            if idx is None:
                 # has not been downloaded and moved before, truly missing
                 insert_mdata_into_df_dict(
-                    success_mdata, df_dict, ImageStatus.MISSING, {}
+                    success_mdata, df_dict, url_rows, ImageStatus.MISSING, {}
                 )
                 continue
 
             # image previously moved
             success_mdata["Image Path"] = df_dict["ImagePath"][idx]
-            img_info = {}
-            for key in (
-                "ImageFileSize",
-                "ImageFormat",
-                "ImageWidth",
-                "ImageHeight",
-                "ImageAspectRatio",
-            ):
-                img_info[key] = df_dict[key][idx]
+            img_info = {key: df_dict[key][idx] for key in IMG_INFO_COLUMNS}
 
             # could be success, filtered, corrupt
-            insert_mdata_into_df_dict(
-                success_mdata, df_dict, df_dict["ImageStatus"][idx], img_info
-            )
-            continue
-        except:
-            # image not readable, handle corrupt image
-            new_img_path = move_img_update_mdata_path(
-                img_path, success_mdata, ImageStatus.CORRUPT
-            )
-            insert_mdata_into_df_dict(
-                success_mdata,
-                df_dict,
-                ImageStatus.CORRUPT,
-                {"ImageFileSize": new_img_path.stat().st_size},
-            )
-            continue
-
-        # handle filtered image
-        if is_filter(img):
-            new_img_path = move_img_update_mdata_path(
-                img_path, success_mdata, ImageStatus.FILTERED
-            )
             insert_mdata_into_df_dict(
                 success_mdata,
                 df_dict,
-                ImageStatus.FILTERED,
-                get_img_info(new_img_path, img),
+                url_rows,
+                ImageStatus(df_dict["ImageStatus"][idx]),
+                img_info,
             )
             continue
 
-        # articles that survive filtration, corruption
-        new_img_path = move_img_update_mdata_path(
-            img_path, success_mdata, ImageStatus.USEFUL
-        )
+        # renaming keeps the size
+        size = files.pop(img_path)
+        probed = probe_img(img_path, verify=is_verify_sample(success_mdata["Id"]))
+        if probed is None:
+            # image not readable
+            img_status = ImageStatus.CORRUPT
+            img_info = {"ImageFileSize": size}
+        elif is_filter_size(probed[1], probed[2]):
+            img_status = ImageStatus.FILTERED
+            img_info = get_img_info(size, *probed)
+        else:
+            # survives filtration, corruption
+            img_status = ImageStatus.USEFUL
+            img_info = get_img_info(size, *probed)
+
+        new_img_path = move_img_update_mdata_path(img_path, success_mdata, img_status)
+        files[new_img_path] = size
         insert_mdata_into_df_dict(
-            success_mdata,
-            df_dict,
-            ImageStatus.USEFUL,
-            get_img_info(new_img_path, img),
+            success_mdata, df_dict, url_rows, img_status, img_info
         )
 
-    # replace json metadata with CSV
-    remove_json_metadata(article_dir)
+
+def process_article_dir(article_dir: Path) -> tuple[str, dict[str, list]]:
+    """Organize the images of one article in a worker process.
+
+    Args:
+        article_dir (Path): Path to the article's directory, relative to the image directory
+
+    Returns:
+        tuple[str, dict[str, list]]: Article Id, and the columns of the rows of this article's images
+    """
+    df_dict = {column: [] for column in DF_COLUMNS}
+    organize_article_imgs(article_dir, df_dict, {})
+    return article_dir.name, df_dict
+
+
+def split_missing_rows(df_dict: dict[str, list]) -> tuple[dict, dict]:
+    """Split rows into the `MISSING` ones and the rest.
+
+    Args:
+        df_dict (dict[str, list]): Columns of the rows of an article
+
+    Returns:
+        tuple[dict, dict]: Columns of the resolved rows, and of the `MISSING` rows
+    """
+    is_missing = [
+        status == ImageStatus.MISSING.value for status in df_dict["ImageStatus"]
+    ]
+    if not any(is_missing):
+        return df_dict, {column: [] for column in DF_COLUMNS}
+
+    resolved_df_dict = {
+        column: [v for v, m in zip(values, is_missing) if not m]
+        for column, values in df_dict.items()
+    }
+    missing_df_dict = {
+        column: [v for v, m in zip(values, is_missing) if m]
+        for column, values in df_dict.items()
+    }
+    return resolved_df_dict, missing_df_dict
+
+
+def resolve_missing_duplicates(
+    missing_df_dict: dict[str, list], stats_buffer: StatsBuffer
+):
+    """Resolve `MISSING` rows whose URL was downloaded and moved by another article.
+
+    Workers only see the rows of their own article, so `MISSING` rows are held back until all articles are done,
+    and matched against the first flushed row of their URL, the same way `organize_article_imgs` does within an
+    article. Only the URL, status, path and image info columns of the flushed rows are streamed back.
+
+    Args:
+        missing_df_dict (dict[str, list]): Columns of the `MISSING` rows of all articles, updated in place
+        stats_buffer (StatsBuffer): Buffer holding the resolved rows of all articles
+    """
+    pending_urls = set(missing_df_dict["ImageUrl"])
+    if len(pending_urls) == 0:
+        return
+
+    copied_columns = ["ImageStatus", "ImagePath", *IMG_INFO_COLUMNS]
+    url_rows = {}
+    stats_buffer.flush()
+    for chunk in stats_buffer.iter_flushed(["ImageUrl", *copied_columns]):
+        chunk = chunk[chunk["ImageUrl"].isin(pending_urls)]
+        for row in chunk.to_dict("records"):
+            url_rows.setdefault(row["ImageUrl"], row)
+
+    for idx, url in enumerate(missing_df_dict["ImageUrl"]):
+        if url not in url_rows:
+            continue
+
+        # image previously moved by another article
+        for key in copied_columns:
+            missing_df_dict[key][idx] = url_rows[url][key]
+
+
+def select_articles(
+    article_ids: list[str], download_journal: DownloadJournal, full: bool
+) -> dict[str, float]:
+    """Pick the articles to classify: those never classified, and those with images recorded in the journal after
+    they were classified (re-downloaded or retried). Articles that are not in the journal (downloaded before it kept
+    the metadata) are classified once.
+
+    Args:
+        article_ids (list[str]): Ids of the article directories
+        download_journal (DownloadJournal): Journal of the image directory
+        full (bool): Classify every article
+
+    Returns:
+        dict[str, float]: Article Id to the latest image update of the articles to classify, to mark them with
+    """
+    article_updates = download_journal.article_updates()
+    postprocessed = {} if full else download_journal.postprocessed_articles()
+
+    selected = {}
+    for article_id in article_ids:
+        updated_at = article_updates.get(article_id, 0.0)
+        if article_id not in postprocessed or postprocessed[article_id] < updated_at:
+            selected[article_id] = updated_at
+    return selected
+
+
+def carry_over_rows(stats_buffer: StatsBuffer, reclassified_ids: set[str]) -> int:
+    """Copy the rows of the articles that are not classified again from the previous output into the buffer, the
+    partial output of an interrupted run if there is one.
+
+    Args:
+        stats_buffer (StatsBuffer): Buffer of the new output
+        reclassified_ids (set[str]): Ids of the articles classified in this run, their old rows are dropped
+
+    Returns:
+        int: Number of rows carried over
+    """
+    num_rows = 0
+    for chunk in stats_buffer.iter_previous(list(DF_COLUMNS)):
+        chunk = chunk[~chunk["ArticleId"].isin(reclassified_ids)]
+        df_dict = chunk.to_dict("list")
+        df_dict["ArticleLang"] = [LANG] * len(chunk)
+        stats_buffer.extend(df_dict)
+        num_rows += len(chunk)
+    return num_rows
 
 
 if __name__ == "__main__":
-    total_articles = sum(1 for item in IMGDIR.iterdir() if item.is_dir())
+    # a single (cached) listing of the image directory, the manifest in the journal decides which articles to classify
+    article_ids = list_article_dirs(IMGDIR)
+    download_journal = DownloadJournal(IMGDIR / JOURNAL_FILENAME)
+    selected_updates = select_articles(article_ids, download_journal, FULL)
+    download_journal.close()  # not shared with the forked workers
+
+    total_articles = len(selected_updates)
     print(
         f"""
     Postprocess Configuration:
         Image Directory: {IMGDIR}, 
         Language: {LANG}, 
-        Total Number of Articles: {total_articles}, 
+        Total Number of Articles: {len(article_ids)}, 
+        Articles to Classify: {total_articles}{" (full)" if FULL else ""}, 
+        Number of Worker Processes: {MAXPROC or os.cpu_count()}, 
+        Output: {get_lang_partition(STATS_DIR, LANG) if OUTPUT_FORMAT == "parquet" else IMGDIR / f"{LANG}.csv"}, 
     """
     )
     _ = input(Fore.YELLOW + "Press ENTER to proceed... (Ctrl+C to cancel)" + Fore.RESET)
 
-    df_dict = {
-        "ImageId": [],
-        "ImageUrl": [],
-        "ArticleId": [],
-        "ArticleLang": [],
-        "ArticleIdx": [],
-        "ArticleUrl": [],
-        "ImageStatus": [],
-        "ImagePath": [],
-        "ImageFileSize": [],
-        "ImageFormat": [],
-        "ImageWidth": [],
-        "ImageHeight": [],
-        "ImageAspectRatio": [],
-    }
-
     os.chdir(IMGDIR)
-    for item in tqdm(Path("./").iterdir(), total=total_articles):
-        if item.is_dir:
-            organize_article_imgs(item, df_dict)
 
-    stat_df = pd.DataFrame(df_dict).set_index("ImageId")
-    stat_df.to_csv(f"{LANG}.csv")
+    # rows are flushed to a partial output in batches, which replaces the language's stats at the end. The articles
+    # of every flush are marked as classified, so an interrupted run is resumed from its partial output
+    if OUTPUT_FORMAT == "parquet":
+        STATS_DIR.mkdir(parents=True, exist_ok=True)
+        stats_path = get_lang_partition(STATS_DIR, LANG)
+    else:
+        stats_path = Path(f"{LANG}.csv")
+    stats_buffer = StatsBuffer(
+        stats_path,
+        DF_COLUMNS,
+        {
+            "ArticleLang": [LANG],
+            "ImageStatus": [status.value for status in ImageStatus],
+        },
+        FLUSH_ROWS,
+        OUTPUT_FORMAT,
+    )
+    missing_df_dict = {column: [] for column in DF_COLUMNS}
+
+    if stats_buffer.resumed:
+        print("Resuming from the partial output of an interrupted run")
+    if FULL:
+        # the partial output only holds the articles classified from here on
+        download_journal = DownloadJournal(IMGDIR / JOURNAL_FILENAME)
+        download_journal.clear_postprocessed()
+        download_journal.close()
+    else:
+        num_carried = carry_over_rows(stats_buffer, set(selected_updates))
+        print(f"Carried over {num_carried} rows of the previous output")
+    stats_buffer.checkpoint()
+
+    article_dirs = [Path(article_id) for article_id in selected_updates]
+
+    # each worker organizes whole articles and returns their rows, merged here
+    with Pool(MAXPROC) as pool:
+        download_journal = DownloadJournal(IMGDIR / JOURNAL_FILENAME)
+
+        # articles whose rows are all in the buffer, marked once it is flushed. Articles with `MISSING` rows are
+        # held back until the end, with their rows
+        flushed_updates = {}
+        for article_id, article_df_dict in tqdm(
+            pool.imap_unordered(process_article_dir, article_dirs, chunksize=64),
+            total=total_articles,
+        ):
+            resolved_df_dict, article_missing_df_dict = split_missing_rows(
+                article_df_dict
+            )
+            if len(article_missing_df_dict["ImageId"]) == 0:
+                flushed_updates[article_id] = selected_updates[article_id]
+            if stats_buffer.extend(resolved_df_dict):
+                download_journal.mark_postprocessed(flushed_updates)
+                flushed_updates = {}
+            for column in DF_COLUMNS:
+                missing_df_dict[column].extend(article_missing_df_dict[column])
+
+    resolve_missing_duplicates(missing_df_dict, stats_buffer)
+    stats_buffer.extend(missing_df_dict)
+    stats_buffer.close()
+
+    # only once their rows are in the output
+    download_journal.mark_postprocessed(selected_updates)
+    download_journal.close()
@@ -0,0 +1,139 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a `Retry-After` header, given either as seconds or as an HTTP date.
+
+    Args:
+        value (str | None): Header value
+
+    Returns:
+        float | None: Seconds to wait, None if the header is missing or malformed
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Token bucket of a single host. Tokens refill at `rate` per second, up to a burst of one second worth of
+    requests. While the host has asked us to back off, no tokens are handed out until `blocked_until`.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # end of the block of the last rate cut
+        self.backed_off_at = -math.inf
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float):
+        capacity = max(1.0, self.rate)
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # waiters queue on the lock, so tokens are handed out in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """Adaptive per-host request rate limiter.
+
+    Each host gets its own `TokenBucket`. The rate of a host is cut in half whenever it throttles us (429/503 or a
+    reset connection) and grows back additively with every successful request, so each host is kept close to the
+    highest rate it tolerates. After a cut, and the block that comes with it, the rate is not cut again for
+    `backoff_window` seconds, nor by the responses to requests sent before the block ended: they were sent at the old
+    rate. So a burst of throttled responses, or a host that throttles a
+    fraction of the requests whatever the rate, does not drive the rate down to `min_rate`.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float,
+        min_rate: float,
+        max_rate: float,
+        ramp_up: float = 0.2,
+        backoff_factor: float = 0.5,
+        backoff_window: float = 5.0,
+    ):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.ramp_up = ramp_up
+        self.backoff_factor = backoff_factor
+        # seconds after the block of a cut during which the rate is not cut again
+        self.backoff_window = backoff_window
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def get_bucket(self, host: str) -> TokenBucket:
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.initial_rate)
+        return self.buckets[host]
+
+    async def acquire(self, host: str):
+        """Wait until a request to the host is allowed.
+
+        Args:
+            host (str): Host, as given by `get_base_url`
+        """
+        await self.get_bucket(host).acquire()
+
+    def success(self, host: str):
+        bucket = self.get_bucket(host)
+        bucket.rate = min(self.max_rate, bucket.rate + self.ramp_up)
+
+    def throttle(self, host: str, sent_at: float, retry_after: float | None = None):
+        """Back off from a host that throttled us.
+
+        Args:
+            host (str): Host, as given by `get_base_url`
+            sent_at (float): `time.monotonic()` when the throttled request was sent
+            retry_after (float | None, optional): Seconds the host asked us to wait, from `Retry-After`. Defaults to
+                None, in which case we wait for one token at the reduced rate.
+        """
+        bucket = self.get_bucket(host)
+        now = time.monotonic()
+        is_cut = (
+            sent_at >= bucket.backed_off_at
+            and now >= bucket.backed_off_at + self.backoff_window
+        )
+        if is_cut:
+            bucket.rate = max(self.min_rate, bucket.rate * self.backoff_factor)
+        bucket.tokens = min(bucket.tokens, 0.0)
+
+        wait = retry_after if retry_after is not None else 1 / bucket.rate
+        bucket.blocked_until = max(bucket.blocked_until, now + wait)
+        # no tokens accumulate while blocked
+        bucket.updated = bucket.blocked_until
+        if is_cut:
+            # the rate only grows back once requests are sent again
+            bucket.backed_off_at = bucket.blocked_until
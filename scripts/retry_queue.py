@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+
+class RetryQueue:
+    """Deferred retries of failed work items, run on the event loop alongside fresh work.
+
+    A failed item is pushed with the number of attempts it already had, and becomes due after an exponential backoff
+    with full jitter: a random delay of up to `base_delay * 2 ** (attempts - 1)` seconds, capped at `max_delay`. Due
+    items are attempted concurrently by `attempt_fn(item, attempt)`, which returns whether the item is finished
+    (succeeded, or failed for good). Unfinished items are pushed again until they had `max_attempts` attempts. Nothing
+    waits on a pending retry but `drain()`, so a flaky item never holds up the work that failed it.
+    """
+
+    def __init__(
+        self,
+        attempt_fn: Callable[[Any, int], Awaitable[bool]],
+        max_attempts: int,
+        base_delay: float = 1,
+        max_delay: float = 60,
+    ):
+        self.attempt_fn = attempt_fn
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.heap: list[tuple[float, int, int, Any]] = []  # (due time, tie breaker, attempts so far, item)
+        self.counter = itertools.count()
+        self.num_running = 0
+        self.changed = asyncio.Event()
+        self.dispatcher: asyncio.Task | None = None
+        self.running: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.heap) + self.num_running
+
+    def get_delay(self, attempts: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+
+    def push(self, item: Any, attempts: int, delay: float | None = None) -> bool:
+        """Schedule another attempt of a failed item.
+
+        Args:
+            item (Any): Work item, passed to `attempt_fn`
+            attempts (int): Attempts the item already had
+            delay (float | None, optional): Seconds until the attempt. Defaults to None, the jittered backoff.
+
+        Returns:
+            bool: Whether it was scheduled, False once the item had `max_attempts` attempts
+        """
+        if attempts >= self.max_attempts:
+            return False
+
+        due = time.monotonic() + (self.get_delay(attempts) if delay is None else delay)
+        heapq.heappush(self.heap, (due, next(self.counter), attempts, item))
+        self.changed.set()
+        return True
+
+    async def attempt(self, item: Any, attempt: int):
+        try:
+            is_finished = await self.attempt_fn(item, attempt)
+            if not is_finished:
+                self.push(item, attempt)
+        finally:
+            self.num_running -= 1
+            self.changed.set()
+
+    async def dispatch(self):
+        while True:
+            self.changed.clear()
+            now = time.monotonic()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                _, _, attempts, item = heapq.heappop(self.heap)
+                self.num_running += 1
+                task = asyncio.ensure_future(self.attempt(item, attempts + 1))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+            timeout = self.heap[0][0] - now if len(self.heap) > 0 else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Start running due retries. Has to be called inside the running event loop."""
+        self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    async def drain(self):
+        """Wait until every pushed item finished or ran out of attempts."""
+        while len(self) > 0:
+            self.changed.clear()
+            await self.changed.wait()
+
+    def close(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
@@ -0,0 +1,294 @@
+import math
+import os
+import shutil
+import uuid
+from array import array
+from pathlib import Path
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from stats_dataset import iter_stats_dataset, write_lang_batch
+
+# column types of the image stats table
+STRING_COLUMNS = ("ImageId", "ImageUrl", "ArticleId", "ArticleUrl", "ImagePath")
+CATEGORICAL_COLUMNS = ("ArticleLang", "ImageStatus", "ImageFormat")
+INT_COLUMNS = ("ArticleIdx", "ImageFileSize", "ImageWidth", "ImageHeight")
+FLOAT_COLUMNS = ("ImageAspectRatio",)
+
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# missing values of the typed arrays
+INT_NULL = -1
+CODE_NULL = -1
+
+
+def is_null(value) -> bool:
+    return (
+        value is None
+        or value is pd.NA
+        or (isinstance(value, float) and math.isnan(value))
+    )
+
+
+class StatsBuffer:
+    """Compact columnar accumulator of image stats rows, flushed to a CSV file or a Parquet dataset in batches.
+
+    Numeric columns are kept in typed arrays and the low cardinality columns (`ArticleLang`, `ImageStatus`,
+    `ImageFormat`) as categorical codes, instead of lists of boxed Python objects. Every `flush_rows` rows the
+    buffer is appended to a partial output and cleared, so memory stays bounded. `close()` renames the partial
+    output to `path`, replacing the previous output only once all rows are written.
+
+    A run first copies the rows it keeps from the previous output (`iter_previous`) into a staging output, and
+    `checkpoint()` turns it into the partial output, which every later flush appends to. A partial output left by
+    an interrupted run is kept, and becomes the previous output of the next run, so the rows it flushed are not
+    lost. An interrupted staging output is discarded, it only held copied rows.
+
+    For CSV, `path` is the CSV file and the partial output is `<path>.partial`. For Parquet, `path` is the language
+    partition `ArticleLang=<lang>` of the stats dataset, every flush adds one file per `ImageStatus` to it, and the
+    partial output is the hidden directory `.ArticleLang=<lang>.partial` next to it, which dataset readers skip.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        columns: tuple[str, ...],
+        categories: dict[str, list[str]],
+        flush_rows: int = 100_000,
+        output_format: str = "csv",
+    ):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+
+        self.path = path
+        self.output_format = output_format
+        self.partial_path = self.get_sibling("partial")
+        # rows copied from the previous output, until `checkpoint()`
+        self.staging_path = self.get_sibling("staging")
+        # partial output of an interrupted run
+        self.resume_path = self.get_sibling("resume")
+        # parquet files of the flush being written
+        self.flush_path = self.get_sibling("flush")
+        self.recover_partial()
+        self.write_path = self.staging_path
+        self.columns = columns
+        self.flush_rows = flush_rows
+        self.nrows = 0
+
+        # categories only grow, so codes stay valid across flushes
+        self.categories = {
+            column: list(categories.get(column, [])) for column in CATEGORICAL_COLUMNS
+        }
+        self.category_codes = {
+            column: {value: code for code, value in enumerate(values)}
+            for column, values in self.categories.items()
+        }
+        self.clear()
+
+    def get_sibling(self, suffix: str) -> Path:
+        if self.output_format == "parquet":
+            return self.path.with_name(f".{self.path.name}.{suffix}")
+        return self.path.with_name(f"{self.path.name}.{suffix}")
+
+    @staticmethod
+    def remove(path: Path):
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+    def recover_partial(self):
+        """Keep the partial output of an interrupted run as the output to resume from."""
+        self.remove(self.staging_path)
+        self.remove(self.flush_path)
+        if self.partial_path.exists():
+            # a resumed run that was interrupted again, its partial output holds the rows of the older one
+            self.remove(self.resume_path)
+            os.replace(self.partial_path, self.resume_path)
+
+        if self.resumed and self.output_format == "csv":
+            # the run may have been killed while appending, drop the incomplete last row
+            with open(self.resume_path, "rb+") as f:
+                end = f.seek(0, os.SEEK_END)
+                pos = end
+                while pos > 0:
+                    start = max(pos - (1 << 16), 0)
+                    f.seek(start)
+                    newline = f.read(pos - start).rfind(b"\n")
+                    if newline >= 0:
+                        f.truncate(start + newline + 1)
+                        break
+                    pos = start
+
+    @property
+    def resumed(self) -> bool:
+        """Whether there is a partial output of an interrupted run to resume from."""
+        return self.resume_path.exists()
+
+    def clear(self):
+        self.data = {}
+        for column in self.columns:
+            if column in CATEGORICAL_COLUMNS:
+                self.data[column] = array("h")
+            elif column in INT_COLUMNS:
+                self.data[column] = array("q")
+            elif column in FLOAT_COLUMNS:
+                self.data[column] = array("d")
+            else:
+                self.data[column] = []
+        self.nrows = 0
+
+    def encode(self, column: str, value) -> int:
+        if is_null(value):
+            return CODE_NULL
+
+        codes = self.category_codes[column]
+        if value not in codes:
+            codes[value] = len(self.categories[column])
+            self.categories[column].append(value)
+        return codes[value]
+
+    def extend(self, df_dict: dict[str, list]) -> bool:
+        """Append rows given as columns, e.g. the rows of one article.
+
+        Args:
+            df_dict (dict[str, list]): Column name to values, all columns of the same length
+
+        Returns:
+            bool: Whether the buffer was flushed, these rows included
+        """
+        for column in self.columns:
+            values = df_dict[column]
+            if column in CATEGORICAL_COLUMNS:
+                self.data[column].extend(self.encode(column, v) for v in values)
+            elif column in INT_COLUMNS:
+                self.data[column].extend(
+                    INT_NULL if is_null(v) else int(v) for v in values
+                )
+            elif column in FLOAT_COLUMNS:
+                self.data[column].extend(
+                    math.nan if is_null(v) else float(v) for v in values
+                )
+            else:
+                self.data[column].extend(None if is_null(v) else v for v in values)
+        self.nrows += len(df_dict[self.columns[0]])
+
+        if self.nrows >= self.flush_rows:
+            return self.flush()
+        return False
+
+    def to_dataframe(self) -> pd.DataFrame:
+        frame = {}
+        for column in self.columns:
+            values = self.data[column]
+            if column in CATEGORICAL_COLUMNS:
+                frame[column] = pd.Categorical.from_codes(
+                    np.frombuffer(values, dtype=np.int16),
+                    categories=self.categories[column],
+                )
+            elif column in INT_COLUMNS:
+                ints = np.frombuffer(values, dtype=np.int64)
+                frame[column] = pd.arrays.IntegerArray(ints.copy(), ints == INT_NULL)
+            elif column in FLOAT_COLUMNS:
+                frame[column] = np.frombuffer(values, dtype=np.float64)
+            else:
+                frame[column] = values
+        return pd.DataFrame(frame, columns=list(self.columns))
+
+    def flush(self) -> bool:
+        """Append the buffered rows to the output being written.
+
+        Returns:
+            bool: Whether there were rows to write
+        """
+        if self.nrows == 0:
+            return False
+
+        if self.output_format == "parquet":
+            # written aside and moved in file by file, so an interrupted flush does not leave a truncated file
+            write_lang_batch(
+                self.to_dataframe(),
+                self.flush_path,
+                f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            )
+            for file in self.flush_path.rglob("*.parquet"):
+                dst = self.write_path / file.relative_to(self.flush_path)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(file, dst)
+            shutil.rmtree(self.flush_path)
+        else:
+            write_header = not self.write_path.exists()
+            self.to_dataframe().to_csv(
+                self.write_path, mode="a", header=write_header, index=False
+            )
+        self.clear()
+        return True
+
+    def checkpoint(self):
+        """Flush the rows copied from the previous output, and make them the start of the partial output. From here
+        on, an interrupted run leaves its flushed rows for the next run to resume from, instead of the previous
+        output.
+        """
+        self.flush()
+        if not self.staging_path.exists():
+            # nothing copied
+            if self.output_format == "parquet":
+                self.staging_path.mkdir(parents=True)
+            else:
+                self.to_dataframe().to_csv(self.staging_path, index=False)
+        os.replace(self.staging_path, self.partial_path)
+        self.remove(self.resume_path)
+        self.write_path = self.partial_path
+
+    def iter_rows(
+        self, path: Path, columns: list[str], chunksize: int
+    ) -> Iterator[pd.DataFrame]:
+        if not path.exists():
+            return
+
+        if self.output_format == "parquet":
+            # `ArticleLang` is not stored in the files of a language partition
+            columns = [column for column in columns if column != "ArticleLang"]
+            yield from iter_stats_dataset(path, columns, chunksize)
+        else:
+            yield from pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+    def iter_flushed(
+        self, columns: list[str], chunksize: int = 100_000
+    ) -> Iterator[pd.DataFrame]:
+        """Stream back the rows flushed so far.
+
+        Args:
+            columns (list[str]): Columns to read
+            chunksize (int, optional): Rows per chunk. Defaults to 100_000.
+
+        Yields:
+            pd.DataFrame: Chunks of the flushed rows
+        """
+        yield from self.iter_rows(self.write_path, columns, chunksize)
+
+    def iter_previous(
+        self, columns: list[str], chunksize: int = 100_000
+    ) -> Iterator[pd.DataFrame]:
+        """Stream the rows of the previous output, e.g. to carry them over into this one: the partial output of an
+        interrupted run if there is one, else the output at `path`.
+
+        Args:
+            columns (list[str]): Columns to read, `ArticleLang` is not read from a Parquet language partition
+            chunksize (int, optional): Rows per chunk. Defaults to 100_000.
+
+        Yields:
+            pd.DataFrame: Chunks of the previous output's rows
+        """
+        yield from self.iter_rows(
+            self.resume_path if self.resumed else self.path, columns, chunksize
+        )
+
+    def close(self):
+        if self.write_path == self.staging_path:
+            self.checkpoint()
+        else:
+            self.flush()
+        if self.output_format == "parquet" and self.path.exists():
+            # output of an earlier run
+            shutil.rmtree(self.path)
+        os.replace(self.partial_path, self.path)
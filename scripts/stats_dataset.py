@@ -0,0 +1,122 @@
+from pathlib import Path
+from typing import Iterator
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# the stats dataset is a hive partitioned Parquet dataset: <root>/ArticleLang=<lang>/ImageStatus=<status>/*.parquet
+PARTITION_COLUMNS = ["ArticleLang", "ImageStatus"]
+# every file is written and read with this schema, instead of one inferred per batch: a batch whose column is all
+# missing, e.g. the `ImagePath` of a language with only failed images, would otherwise be written as a `null` column
+# that the other files' columns cannot be cast to
+STATS_SCHEMA = pa.schema(
+    [
+        ("ImageId", pa.string()),
+        ("ImageUrl", pa.string()),
+        ("ArticleId", pa.string()),
+        ("ArticleIdx", pa.int64()),
+        ("ArticleUrl", pa.string()),
+        ("ImagePath", pa.string()),
+        ("ImageFileSize", pa.int64()),
+        ("ImageFormat", pa.dictionary(pa.int32(), pa.string())),
+        ("ImageWidth", pa.int64()),
+        ("ImageHeight", pa.int64()),
+        ("ImageAspectRatio", pa.float64()),
+        ("ArticleLang", pa.string()),
+        ("ImageStatus", pa.string()),
+    ]
+)
+
+
+def get_lang_partition(root: Path, lang: str) -> Path:
+    return root / f"ArticleLang={lang}"
+
+
+def write_lang_batch(df: pd.DataFrame, lang_dir: Path, basename_template: str):
+    """Append a batch of rows of one language to its partition, as new files under `ImageStatus=<status>/`.
+
+    Args:
+        df (pd.DataFrame): Rows of the batch, all of the same `ArticleLang`
+        lang_dir (Path): Directory of the language partition
+        basename_template (str): File name template, has to contain `{i}` and be unique per batch
+    """
+    df = df.drop(columns="ArticleLang")
+    df["ImageStatus"] = df["ImageStatus"].astype(str)
+    schema = pa.schema([STATS_SCHEMA.field(column) for column in df.columns])
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    pq.write_to_dataset(
+        table,
+        root_path=str(lang_dir),
+        partition_cols=["ImageStatus"],
+        basename_template=basename_template,
+    )
+
+
+def open_stats_dataset(root: Path) -> ds.Dataset:
+    # `ArticleLang` is not a column of the files, nor a partition below the root of a single language partition
+    columns = (
+        PARTITION_COLUMNS[1:] if root.name.startswith("ArticleLang=") else PARTITION_COLUMNS
+    )
+    schema = pa.schema(
+        [
+            field
+            for field in STATS_SCHEMA
+            if field.name not in PARTITION_COLUMNS or field.name in columns
+        ]
+    )
+    partitioning = ds.partitioning(
+        pa.schema([STATS_SCHEMA.field(column) for column in columns]), flavor="hive"
+    )
+    return ds.dataset(str(root), schema=schema, format="parquet", partitioning=partitioning)
+
+
+def to_pandas(data: pa.Table | pa.RecordBatch) -> pd.DataFrame:
+    # integer columns with missing values stay nullable integers, as `StatsBuffer` writes them
+    return data.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def read_stats_dataset(
+    root: Path,
+    columns: list[str] | None = None,
+    filter: ds.Expression | None = None,
+) -> pd.DataFrame:
+    """Load the stats table of one or more languages. Only the requested columns are read, and the filter is
+    pushed down, so partitions (`ArticleLang`, `ImageStatus`) that do not match are never opened.
+
+    Example:
+        read_stats_dataset(
+            root,
+            columns=["ImageId", "ImagePath", "ArticleIdx"],
+            filter=(ds.field("ImageStatus") == "USEFUL") & (ds.field("ArticleIdx") == 0),
+        )
+
+    Args:
+        root (Path): Root directory of the dataset, or of a single language partition
+        columns (list[str] | None, optional): Columns to read. Defaults to None, all columns.
+        filter (ds.Expression | None, optional): Row filter. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Matching rows
+    """
+    table = open_stats_dataset(root).to_table(columns=columns, filter=filter)
+    return to_pandas(table)
+
+
+def iter_stats_dataset(
+    root: Path, columns: list[str], batch_size: int = 100_000
+) -> Iterator[pd.DataFrame]:
+    """Stream the stats table in batches of rows.
+
+    Args:
+        root (Path): Root directory of the dataset, or of a single language partition
+        columns (list[str]): Columns to read
+        batch_size (int, optional): Maximum rows per batch. Defaults to 100_000.
+
+    Yields:
+        pd.DataFrame: Batches of rows
+    """
+    for batch in open_stats_dataset(root).to_batches(
+        columns=columns, batch_size=batch_size
+    ):
+        yield to_pandas(batch)
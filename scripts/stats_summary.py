@@ -0,0 +1,233 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from stats_dataset import iter_stats_dataset
+
+SUMMARY_COLUMNS = [
+    "ArticleLang",
+    "ArticleId",
+    "ImageStatus",
+    "ImageFormat",
+    "ImageWidth",
+    "ImageHeight",
+    "ImageAspectRatio",
+]
+
+# histogram bin edges of the useful images, values past the last edge are counted in the last bin
+HISTOGRAM_BINS = {
+    "ImageWidth": np.arange(0, 4096 + 64, 64),
+    "ImageHeight": np.arange(0, 4096 + 64, 64),
+    "ImageAspectRatio": np.round(np.geomspace(0.25, 4, 41), 4),
+}
+
+# bump when the summary changes, so older cached summaries are recomputed
+SUMMARY_VERSION = 1
+CACHE_FILENAME = ".summary_cache.json"
+
+
+def get_input_files(inputs: list[Path]) -> list[Path]:
+    """Data files of the inputs: the Parquet files of a stats dataset directory, or CSV files as given."""
+    files = []
+    for path in inputs:
+        if path.is_dir():
+            files.extend(
+                sorted(
+                    file
+                    for file in path.rglob("*.parquet")
+                    if not any(part.startswith((".", "_")) for part in file.relative_to(path).parts)
+                )
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def get_fingerprint(files: list[Path]) -> str:
+    """Fingerprint of the inputs, changes whenever a data file is added, removed or rewritten."""
+    hasher = hashlib.sha256(f"v{SUMMARY_VERSION}".encode())
+    for file in files:
+        stat = file.stat()
+        hasher.update(f"{file.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()
+
+
+def iter_batches(inputs: list[Path], batch_size: int = 500_000) -> Iterator[pd.DataFrame]:
+    """Stream the summary columns of the inputs, stats dataset directories or CSV files of `postprocess.py`."""
+    for path in inputs:
+        if path.is_dir():
+            yield from iter_stats_dataset(path, SUMMARY_COLUMNS, batch_size)
+        else:
+            yield from pd.read_csv(path, usecols=SUMMARY_COLUMNS, chunksize=batch_size)
+
+
+def compute_summary(inputs: list[Path]) -> dict:
+    """Compute the headline statistics of the image stats in one streaming pass. Every batch is reduced with
+    vectorized group-bys and `np.histogram`, and only the reductions are kept: status counts per language, one row per
+    (language, article) with its number of useful images, histograms and format counts of the useful images.
+
+    Args:
+        inputs (list[Path]): Stats dataset directories or CSV files
+
+    Returns:
+        dict: Summary, see `summary_to_frames` for its fields
+    """
+    status_counts = []
+    article_useful = []
+    histograms = {
+        column: np.zeros(len(bins) - 1, dtype=np.int64)
+        for column, bins in HISTOGRAM_BINS.items()
+    }
+    format_counts = []
+
+    for batch in iter_batches(inputs):
+        batch = batch.astype({"ArticleLang": str, "ImageStatus": str})
+        is_useful = batch["ImageStatus"] == "USEFUL"
+
+        status_counts.append(
+            batch.groupby(["ArticleLang", "ImageStatus"]).size()
+        )
+        article_useful.append(
+            is_useful.groupby([batch["ArticleLang"], batch["ArticleId"]]).sum()
+        )
+
+        useful = batch[is_useful]
+        for column, bins in HISTOGRAM_BINS.items():
+            values = useful[column].dropna().to_numpy(dtype=np.float64)
+            counts, _ = np.histogram(np.clip(values, bins[0], bins[-1]), bins=bins)
+            histograms[column] += counts
+        format_counts.append(useful["ImageFormat"].astype(str).value_counts())
+
+    if len(status_counts) == 0:
+        return {}
+
+    status_counts = pd.concat(status_counts).groupby(level=[0, 1]).sum()
+    # an article's rows may be split across batches (one file per status)
+    article_useful = pd.concat(article_useful).groupby(level=[0, 1]).sum()
+    articles = article_useful.groupby(level=0).agg(
+        Articles="size", UsefulArticles=lambda counts: int((counts > 0).sum())
+    )
+    articles["UsefulCoverage"] = articles["UsefulArticles"] / articles["Articles"]
+
+    article_ids = article_useful.index.get_level_values(1)
+    duplicate_ids = sorted(set(article_ids[article_ids.duplicated()]))
+    format_counts = pd.concat(format_counts).groupby(level=0).sum()
+
+    return {
+        "status_counts": {
+            f"{lang}\0{status}": int(count) for (lang, status), count in status_counts.items()
+        },
+        "articles": articles.reset_index(names="ArticleLang").to_dict("list"),
+        "total_articles": int(len(article_useful)),
+        "useful_articles": int((article_useful > 0).sum()),
+        "duplicate_article_ids": duplicate_ids,
+        "histograms": {
+            column: {"edges": HISTOGRAM_BINS[column].tolist(), "counts": counts.tolist()}
+            for column, counts in histograms.items()
+        },
+        "format_counts": {fmt: int(count) for fmt, count in format_counts.items()},
+    }
+
+
+def load_summary(inputs: list[Path], cache_path: Path | None = None) -> dict:
+    """Summary of the inputs, from the cache if the inputs are unchanged since it was computed.
+
+    Args:
+        inputs (list[Path]): Stats dataset directories or CSV files
+        cache_path (Path | None, optional): Cache file. Defaults to None, `.summary_cache.json` in the first input
+            directory (next to the first input file).
+
+    Returns:
+        dict: Summary, see `summary_to_frames`
+    """
+    if cache_path is None:
+        first = inputs[0]
+        cache_path = (first if first.is_dir() else first.parent) / CACHE_FILENAME
+
+    fingerprint = get_fingerprint(get_input_files(inputs))
+    try:
+        with cache_path.open() as f:
+            cached = json.load(f)
+        if cached["fingerprint"] == fingerprint:
+            return cached["summary"]
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+
+    summary = compute_summary(inputs)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump({"fingerprint": fingerprint, "summary": summary}, f)
+    os.replace(tmp_path, cache_path)
+    return summary
+
+
+def summary_to_frames(summary: dict) -> dict:
+    """Turn a summary into pandas objects for the notebooks.
+
+    Returns:
+        dict: `status_counts` (languages x statuses), `articles` (unique, useful articles and coverage per language),
+            `duplicate_article_ids` (Article Ids found in several languages), `histograms` (bin edges and counts of
+            the useful images' width, height and aspect ratio), `formats` (useful images per format), and the
+            `total_articles` and `useful_articles` counts
+    """
+    status_counts = pd.Series(
+        {tuple(key.split("\0")): count for key, count in summary["status_counts"].items()}
+    ).unstack(fill_value=0)
+    histograms = {
+        column: pd.DataFrame(
+            {
+                "Left": histogram["edges"][:-1],
+                "Right": histogram["edges"][1:],
+                "Count": histogram["counts"],
+            }
+        )
+        for column, histogram in summary["histograms"].items()
+    }
+    return {
+        "status_counts": status_counts,
+        "articles": pd.DataFrame(summary["articles"]).set_index("ArticleLang"),
+        "total_articles": summary["total_articles"],
+        "useful_articles": summary["useful_articles"],
+        "duplicate_article_ids": summary["duplicate_article_ids"],
+        "histograms": histograms,
+        "formats": pd.Series(summary["format_counts"]).sort_values(ascending=False),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="Stats dataset directory (e.g. `data/images/stats`) or `<lang>.csv` files",
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None, help="Summary cache file, defaults to the first input's directory"
+    )
+    args = parser.parse_args()
+
+    summary = load_summary(
+        [Path(path) for path in args.inputs], Path(args.cache) if args.cache else None
+    )
+    if len(summary) == 0:
+        print("No stats rows found")
+        sys.exit(0)
+
+    frames = summary_to_frames(summary)
+    print("Images by status:")
+    print(frames["status_counts"])
+    print()
+    print("Articles by language:")
+    print(frames["articles"])
+    print()
+    print(f"Articles: {frames['total_articles']}, with at least one useful image: {frames['useful_articles']}")
+    print(f"Article Ids in more than one language: {len(frames['duplicate_article_ids'])}")
+    print()
+    print("Useful images by format:")
+    print(frames["formats"])
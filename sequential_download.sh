@@ -9,7 +9,7 @@ NC='\033[0m' # No color
 slice_len=500
 metadata_filepath="/home/salkhon/Documents/thesis/data/metadata/punjabi.metadata"
 img_download_dir="/home/salkhon/Documents/thesis/data/images"
-cooldown=5
+cooldown=0
 max_retry=3
 start=0
 timeout=$((5 * 60))
@@ -90,10 +90,17 @@ for ((start_idx = start; start_idx < total_articles; start_idx += slice_len)); d
         --max-retry $max_retry
 
     echo -e "\n${GREEN}\tDownload Complete: Start Index: $start_idx\t End Index: $end_idx. ${NC}"
-    echo -e "${RED}\tNumber of articles with exceptions: $(find "$img_download_dir" -type f -name exceptions_metadata.json | wc -l). ${NC}"
-    echo -e "\tCooling down for $cooldown seconds\n"
-
-    if [[ $end_idx -lt $total_articles ]]; then
+    # failed images are recorded in the language's download journal
+    # a slice without any image to record leaves no journal behind
+    journal_file="$img_download_dir/download_journal.sqlite3"
+    articles_with_exceptions=0
+    if [ -f "$journal_file" ]; then
+        articles_with_exceptions=$(PYTHONPATH=scripts python3 -c 'import sys; from pathlib import Path; from download_journal import DownloadJournal; journal = DownloadJournal(Path(sys.argv[1])); print(journal.count_failed_articles()); journal.close()' "$journal_file")
+    fi
+    echo -e "${RED}\tNumber of articles with exceptions: $articles_with_exceptions. ${NC}"
+    # requests are already paced per host by the downloader, cooldown is only an extra safety margin
+    if [[ $cooldown -gt 0 && $end_idx -lt $total_articles ]]; then
+        echo -e "\tCooling down for $cooldown seconds\n"
         sleep $cooldown
     fi
 done